@@ -0,0 +1,346 @@
+"""Asynchronous extensions of ParsedCmd: async dispatch and a network server.
+
+These require Python 3's syntax and are kept out of parsedcmd.py so that the
+latter can still be imported by Python 2.  asyncio, and the modules used by
+the line reader and the server, are only imported when needed, to keep the
+import of parsedcmd cheap.
+"""
+
+import inspect
+
+class AsyncCmdMixin(object):
+    """Mixin providing `aonecmd' and `acmdloop' to ParsedCmd."""
+
+    async def aonecmd(self, line):
+        """Like onecmd, but await coroutine `do_*' methods.
+
+        The argument list is constructed exactly as in onecmd.  If stdout is
+        a `BufferedOutput', the command ends when the coroutine completes.
+        """
+        output = self.stdout
+        begin = getattr(output, "begin_command", None)
+        if begin is None or output.in_command:
+            result = self.onecmd(line)
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+        begin()
+        try:
+            return await self.aonecmd(line)
+        finally:
+            output.end_command()
+
+    async def acmdloop(self, intro=None):
+        """Like cmdloop, but without blocking the event loop.
+
+        Input is read in a separate thread.  Coroutine `do_*' methods are run
+        as tasks, and the next prompt is issued without waiting for them to
+        complete; if such a command returns a true value (once passed through
+        `postcmd'), the loop stops.  When the loop stops, the commands that
+        are still running are cancelled.  An exception raised by a command is
+        propagated.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        self.preloop()
+        if self.use_rawinput and self.completekey:
+            try:
+                import readline
+                self.old_completer = readline.get_completer()
+                readline.set_completer(self.complete)
+                readline.parse_and_bind(self.completekey+": complete")
+            except ImportError:
+                pass
+        reader = _LineReader(self, loop)
+        tasks = set()
+        stopped = loop.create_future()
+
+        def task_done(task, line):
+            tasks.discard(task)
+            if task.cancelled() or stopped.done():
+                return
+            exc = task.exception()
+            if exc is not None:
+                stopped.set_exception(exc)
+            elif self.postcmd(task.result(), line):
+                stopped.set_result(True)
+
+        try:
+            if intro is not None:
+                self.intro = intro
+            if self.intro:
+                self.stdout.write(str(self.intro)+"\n")
+            stop = None
+            while not stop:
+                if self.cmdqueue:
+                    line = self.cmdqueue.pop(0)
+                else:
+                    read = reader.read(self.prompt)
+                    await asyncio.wait([read, stopped],
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    if stopped.done():
+                        stopped.result()
+                        break
+                    line = read.result()
+                line = self.precmd(line)
+                stop = self.onecmd(line)
+                if isinstance(stop, asyncio.Future):
+                    tasks.add(stop)
+                    stop.add_done_callback(
+                        lambda task, line=line: task_done(task, line))
+                    stop = None
+                else:
+                    stop = self.postcmd(stop, line)
+                if stopped.done():
+                    stopped.result()
+                    break
+            self.postloop()
+        finally:
+            reader.close()
+            for task in list(tasks):
+                task.cancel()
+            if tasks:
+                await asyncio.wait(tasks)
+            if self.use_rawinput and self.completekey:
+                try:
+                    import readline
+                    readline.set_completer(self.old_completer)
+                except ImportError:
+                    pass
+
+    async def _await_deadline(self, coro, token):
+        """Await coro, cancelling it when the deadline of token passes, and
+        report the cancellation through `cancel_error'.
+
+        token is the `cancel_token' of the ParsedCmd while coro runs (when
+        several such tasks run concurrently, that of the latest one).
+        """
+        import asyncio
+        from parsedcmd import CommandCancelled
+        saved = self._install_token(token)
+        try:
+            return await asyncio.wait_for(coro, token.remaining())
+        except asyncio.TimeoutError:
+            if not token.expired:
+                raise
+            return self.cancel_error(token.cmd, token.timeout)
+        except CommandCancelled as exc:
+            return self.cancel_error(*exc.args)
+        finally:
+            self._restore_token(token, saved)
+
+class _LineReader(object):
+    """Read lines in a daemon thread on behalf of an event loop, as cmdloop
+    would."""
+
+    def __init__(self, cmd, loop):
+        import queue
+        import threading
+        self._cmd = cmd
+        self._loop = loop
+        self._requests = queue.Queue()
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def read(self, prompt):
+        """Return a future resolving to the next line."""
+        future = self._loop.create_future()
+        self._requests.put((prompt, future))
+        return future
+
+    def close(self):
+        self._requests.put((None, None))
+
+    def _run(self):
+        while True:
+            prompt, future = self._requests.get()
+            if future is None:
+                return
+            try:
+                line = self._readline(prompt)
+            except BaseException as exc:
+                self._loop.call_soon_threadsafe(_set_exception, future, exc)
+            else:
+                self._loop.call_soon_threadsafe(_set_result, future, line)
+
+    def _readline(self, prompt):
+        cmd = self._cmd
+        if cmd.use_rawinput:
+            try:
+                return input(prompt)
+            except EOFError:
+                return "EOF"
+        else:
+            cmd.stdout.write(prompt)
+            cmd.stdout.flush()
+            line = cmd.stdin.readline()
+            if not len(line):
+                return "EOF"
+            return line.rstrip("\r\n")
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+def _set_exception(future, exc):
+    if not future.done():
+        future.set_exception(exc)
+
+class CmdServer(object):
+    """Serve sessions of a ParsedCmd subclass over TCP or Unix sockets.
+
+    Each connection gets its own interpreter (a session), constructed as
+    `cmd_class(stdout=..., **kwargs)', whose stdout writes to the connection.
+    Sessions are all instances of cmd_class and thus share the compiled
+    bindings of its `do_*' methods.  Commands are run with `aonecmd', so
+    coroutine commands do not block other sessions (but synchronous commands
+    do).
+
+    At most max_connections sessions are served at once (further connections
+    are refused), sessions that send nothing for idle_timeout seconds are
+    closed, and lines longer than limit bytes are rejected.
+
+    Unless cmd_class sets `buffer_output' or it is passed as a keyword
+    argument, the output of each command is buffered and sent in one write
+    when the command ends (`buffer_output="command"').
+    """
+
+    def __init__(self, cmd_class, max_connections=None, idle_timeout=None,
+                 encoding="utf-8", limit=2 ** 16, **kwargs):
+        self.cmd_class = cmd_class
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.encoding = encoding
+        self.limit = limit
+        if cmd_class.buffer_output is None:
+            kwargs.setdefault("buffer_output", "command")
+        self.kwargs = kwargs
+        self.sessions = set()
+        self.servers = []
+        self._connections = {}
+
+    async def start_tcp(self, host=None, port=0, **kwargs):
+        """Start listening on a TCP socket; return the `asyncio.Server'."""
+        import asyncio
+        server = await asyncio.start_server(
+            self._handle, host, port, limit=self.limit, **kwargs)
+        self.servers.append(server)
+        return server
+
+    async def start_unix(self, path, **kwargs):
+        """Start listening on a Unix socket; return the `asyncio.Server'."""
+        import asyncio
+        server = await asyncio.start_unix_server(
+            self._handle, path, limit=self.limit, **kwargs)
+        self.servers.append(server)
+        return server
+
+    async def serve_forever(self):
+        """Serve on all started sockets until cancelled."""
+        import asyncio
+        await asyncio.gather(*[server.serve_forever()
+                               for server in self.servers])
+
+    async def close(self):
+        """Stop listening, close all connections, and wait for the sessions to
+        end.
+
+        A command that is running is not interrupted, but its session ends
+        once it completes."""
+        import asyncio
+        for server in self.servers:
+            server.close()
+        for server in self.servers:
+            await server.wait_closed()
+        self.servers = []
+        for writer in self._connections.values():
+            writer.close()
+        if self._connections:
+            await asyncio.wait(list(self._connections))
+
+    async def _handle(self, reader, writer):
+        import asyncio
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        output = _StreamOutput(writer, self.encoding)
+        try:
+            if (self.max_connections is not None and
+                len(self.sessions) >= self.max_connections):
+                output.write("*** Too many connections.\n")
+                await writer.drain()
+                return
+            session = self.cmd_class(stdout=output, **self.kwargs)
+            session.use_rawinput = False
+            self.sessions.add(session)
+            try:
+                await self._run_session(session, reader, writer)
+            finally:
+                self.sessions.discard(session)
+        except ConnectionError:
+            pass
+        finally:
+            del self._connections[task]
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _run_session(self, session, reader, writer):
+        import asyncio
+        import traceback
+        session.preloop()
+        try:
+            if session.intro:
+                session.stdout.write(str(session.intro)+"\n")
+            stop = None
+            while not stop:
+                if session.cmdqueue:
+                    line = session.cmdqueue.pop(0)
+                else:
+                    session.stdout.write(session.prompt)
+                    await writer.drain()
+                    try:
+                        data = await asyncio.wait_for(reader.readline(),
+                                                      self.idle_timeout)
+                    except asyncio.TimeoutError:
+                        session.stdout.write("\n*** Idle timeout.\n")
+                        break
+                    except ValueError:
+                        session.stdout.write("*** Line too long.\n")
+                        continue
+                    if not data:
+                        break
+                    line = data.decode(self.encoding, "replace")
+                    line = line.rstrip("\r\n")
+                line = session.precmd(line)
+                try:
+                    stop = await session.aonecmd(line)
+                except Exception as exc:
+                    session.stdout.write("*** " + "".join(
+                        traceback.format_exception_only(type(exc), exc)))
+                    stop = None
+                stop = session.postcmd(stop, line)
+        finally:
+            session.postloop()
+        await writer.drain()
+
+class _StreamOutput(object):
+    """File-like object writing encoded text to an asyncio StreamWriter.
+
+    Flushing is a no-op: the session drains the writer after each command.
+    """
+
+    def __init__(self, writer, encoding):
+        self._writer = writer
+        self._encoding = encoding
+
+    def write(self, data):
+        self._writer.write(data.encode(self._encoding))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
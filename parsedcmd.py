@@ -6,8 +6,9 @@ lists, instead of the raw input, as long as the method has not been decorated
 with `@gets_raw`.
 
 The parsing is done in the following steps:
-  - the input line is passed to the `split()' method (by default
-    `shlex.split()'), and the result is bound to the argument list of the
+  - the input line is passed to the `split()' method (by default, a fast
+    tokenizer equivalent to `shlex.split()', which can be changed through the
+    `tokenizer' attribute), and the result is bound to the argument list of the
     `do_*' method.
   - initial options (`-opt val') are assigned to keyword-only arguments (which
     can be simulated in Python 2 using the `@kw_only' decorator).
@@ -33,23 +34,36 @@ by passing it as a keyword argument to the constructor), then help messages
 that are derived from docstrings (not those that are derived from a `help_*`
 method) are appended with a pretty-printed version of the method's signature,
 if the methods is not `@gets_raw`ed.
+
+The signature of each `do_*` method is introspected only once per class, the
+first time the method is dispatched to; the resulting binding is reused until
+the method is replaced.  Setting the `compile_bindings` attribute to false
+restores the original behavior of introspecting the method on every call.
 """
 
 from __future__ import print_function
 from collections import namedtuple
 from cmd import Cmd
+import bisect
+import collections
 import functools
 import inspect
 import itertools
-import shlex
+import re
 import sys
-import textwrap
+import time
 
-__all__ = ["gets_raw", "use_my_annotations", "ParsedCmd", "boolean"]
+__all__ = ["gets_raw", "use_my_annotations", "parallel_safe", "cached",
+           "invalidates", "timeout", "ParsedCmd", "LazyCommand", "boolean",
+           "many", "CastError", "CommandCancelled", "CancelToken", "Caster",
+           "caster", "register_caster", "get_caster", "CommandRecorder",
+           "BufferedOutput", "stats_command"]
 
 if sys.version_info[0] >= 3:
     getfullargspec = inspect.getfullargspec
     getcallargs = inspect.getcallargs
+    iscoroutine = inspect.iscoroutine
+    timer = time.perf_counter
 
     basestring = str
 
@@ -58,6 +72,12 @@ else:
         raise Exception("Cmd2 requires Python >= 2.6.")
     __all__.extend(["wraps", "annotate", "kw_only"])
 
+    def iscoroutine(obj):
+        """Coroutines do not exist in Python 2."""
+        return False
+
+    timer = time.time
+
     def getfullargspec(func):
         """Imitate Python 3's inspect.getfullargspec"""
         args_, varargs, varkw, defaults_ = inspect.getargspec(func)
@@ -209,19 +229,1507 @@ def use_my_annotations(func):
     setattr(func, USE_MY_ANNOTATIONS, True)
     return func
 
+PARALLEL_SAFE = "_parallel_safe"
+def parallel_safe(func):
+    """Decorator indicating that the do_* method can run concurrently with
+    other commands in `ParsedCmd.run_script'.
+    """
+    setattr(func, PARALLEL_SAFE, True)
+    return func
+
+TIMEOUT = "_timeout"
+def timeout(seconds):
+    """Decorator factory setting the deadline of the do_* method, in seconds
+    (overriding `ParsedCmd.command_timeout'); None removes the deadline.
+    """
+    def decorator(func):
+        setattr(func, TIMEOUT, seconds)
+        return func
+    return decorator
+
+CacheInfo = namedtuple("CacheInfo", "hits misses evictions currsize maxsize")
+
+def cached(maxsize=128, ttl=None, result=False, shared=False):
+    """Decorator factory memoizing the output of a `do_*' method.
+
+    What the method writes to `self.stdout' is recorded, keyed on its bound
+    and cast arguments, and written again, without running the method, when
+    it is called with equal arguments; the method must thus only depend on
+    its arguments (and on the instance, as each instance has its own cache
+    unless shared is true).  If result is true, the return value is memoized
+    too; otherwise, calls answered from the cache return None.  At most
+    maxsize entries (None for no limit) are kept per cache, the least
+    recently used being evicted first, for at most ttl seconds if given.
+    Calls with unhashable or iterator arguments, calls that raise, and calls
+    that return an iterator or a coroutine are not cached.
+
+    The decorated method has `cache_info()' (returning a `CacheInfo' summed
+    over all caches) and `cache_clear(obj=None)' (clearing the cache of obj,
+    or all caches) methods; see also `invalidates'.
+    """
+    def decorator(func):
+        import weakref
+        caches = weakref.WeakKeyDictionary()
+        shared_cache = collections.OrderedDict()
+        counts = {"hits": 0, "misses": 0, "evictions": 0}
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            key = _cache_key(args, kwargs)
+            if key is None:
+                return func(self, *args, **kwargs)
+            if shared:
+                cache = shared_cache
+            else:
+                cache = caches.get(self)
+                if cache is None:
+                    cache = caches[self] = collections.OrderedDict()
+            now = timer()
+            entry = cache.pop(key, None)
+            if entry is not None:
+                expires, output, value = entry
+                if expires is None or now < expires:
+                    cache[key] = entry # most recently used
+                    counts["hits"] += 1
+                    if output:
+                        self.stdout.write(output)
+                    return value
+                counts["evictions"] += 1
+            counts["misses"] += 1
+            stdout = self.stdout
+            if isinstance(stdout, _ThreadOutput):
+                # Shared by threads: only record what this thread writes.
+                stdout.record()
+                try:
+                    value = func(self, *args, **kwargs)
+                finally:
+                    output = stdout.stop_recording()
+            else:
+                self.stdout = tee = _TeeOutput(stdout)
+                try:
+                    value = func(self, *args, **kwargs)
+                finally:
+                    self.stdout = stdout
+                output = tee.getvalue()
+            if iscoroutine(value) or _is_iterator(value):
+                return value
+            cache[key] = (None if ttl is None else now + ttl, output,
+                          value if result else None)
+            if maxsize is not None and len(cache) > maxsize:
+                cache.popitem(last=False)
+                counts["evictions"] += 1
+            return value
+
+        def cache_info():
+            currsize = len(shared_cache) + sum(map(len, caches.values()))
+            return CacheInfo(counts["hits"], counts["misses"],
+                             counts["evictions"], currsize, maxsize)
+
+        def cache_clear(obj=None):
+            if obj is None or shared:
+                shared_cache.clear()
+                caches.clear()
+            else:
+                caches.pop(obj, None)
+
+        wrapper.__wrapped__ = func
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator
+
+def invalidates(*names):
+    """Decorator factory indicating that the `do_*' method invalidates the
+    `@cached' results of the commands names, whose caches for the instance
+    are cleared after it runs.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                for name in names:
+                    cached_func = _find_cached(getattr(self, "do_" + name,
+                                                       None))
+                    if cached_func is not None:
+                        cached_func.cache_clear(self)
+        wrapper.__wrapped__ = func
+        return wrapper
+    return decorator
+
+def _find_cached(func):
+    """Return the `@cached' function in the `__wrapped__' chain of func, or
+    None."""
+    while func is not None:
+        if hasattr(func, "cache_clear"):
+            return func
+        func = getattr(func, "__wrapped__", None)
+    return None
+
+def _is_iterator(value):
+    return hasattr(value, "__next__") or hasattr(value, "next")
+
+def _cache_key(args, kwargs):
+    """Return a hashable key for the arguments of a call, or None if the call
+    cannot be cached."""
+    key = tuple(tuple(arg) if isinstance(arg, list) else arg for arg in args)
+    if kwargs:
+        key += tuple(sorted(kwargs.items()))
+    for arg in itertools.chain(args, kwargs.values()):
+        if _is_iterator(arg):
+            return None
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+class LazyCommand(object):
+    """A `do_*' method imported from a module on first use.
+
+    target is a "module:function" string, where function takes the
+    interpreter as first argument, like a method.  signature, as returned by
+    `ParsedCmd.command_signatures' for the command, allows help and
+    completion to work without importing the module; doc is the docstring
+    used by help (by default, the one given in signature).
+    """
+
+    def __init__(self, target, signature=None, doc=None):
+        self.target = target
+        self.signature = signature
+        if doc is None and signature is not None:
+            doc = signature.get("doc")
+        self.doc = doc
+
+    def resolve(self):
+        """Import and return the function."""
+        import importlib
+        module, _, qualname = self.target.partition(":")
+        func = importlib.import_module(module)
+        for attr in qualname.split("."):
+            func = getattr(func, attr)
+        return func
+
+    def __get__(self, obj, cls):
+        func = self.resolve()
+        # replace the placeholder, so that later lookups are direct
+        for klass in cls.__mro__:
+            for name, value in list(vars(klass).items()):
+                if value is self:
+                    setattr(klass, name, func)
+        return func.__get__(obj, cls)
+
 class ArgListError(Exception):
     """The argument list to the dispatched method could not be constructed."""
     pass
 
-class ParsedCmd(Cmd, object):
+class CastError(ValueError):
+    """An argument could not be cast while a lazy `many' parameter was being
+    iterated over.
+
+    The arguments of the exception are those of `ParsedCmd.cast_error'."""
+    pass
+
+class CommandCancelled(Exception):
+    """A command was cancelled, by its deadline or explicitly.
+
+    The arguments of the exception are those of `ParsedCmd.cancel_error'."""
+    pass
+
+class CancelToken(object):
+    """Cooperative cancellation token of a command with a deadline.
+
+    While such a command runs, its token is the `cancel_token' attribute of
+    the ParsedCmd; the command should call `check' regularly (e.g., once per
+    iteration of its main loop), which raises `CommandCancelled' once the
+    deadline has passed or `cancel' has been called (possibly from another
+    thread).  Commands without a deadline see a token that is never
+    cancelled (give them a deadline of `float("inf")' to cancel them
+    explicitly).
+    """
+
+    def __init__(self, timeout=None, cmd=None):
+        self.timeout = timeout
+        self.cmd = cmd
+        self.deadline = None if timeout is None else timer() + timeout
+        self._cancelled = False
+
+    def cancel(self):
+        """Request the cancellation of the command."""
+        self._cancelled = True
+
+    @property
+    def expired(self):
+        """Whether the deadline has passed."""
+        return self.deadline is not None and timer() >= self.deadline
+
+    @property
+    def cancelled(self):
+        """Whether the command should stop."""
+        return self._cancelled or self.expired
+
+    def remaining(self):
+        """Return the time left before the deadline, or None."""
+        if self.deadline is None or self.deadline == float("inf"):
+            return None
+        return max(self.deadline - timer(), 0)
+
+    def check(self):
+        """Raise `CommandCancelled' if the command should stop."""
+        if self._cancelled:
+            raise CommandCancelled(self.cmd, None)
+        if self.expired:
+            raise CommandCancelled(self.cmd, self.timeout)
+
+class _NeverCancelled(CancelToken):
+    """The token of commands without a deadline."""
+
+    def cancel(self):
+        pass
+
+class _ThreadCancelToken(object):
+    """Stand-in for the `cancel_token' of a ParsedCmd whose commands run in
+    several threads, delegating to the token of the command running in the
+    current thread (or to default)."""
+
+    def __init__(self, default):
+        import threading
+        self.default = default
+        self._local = threading.local()
+
+    def swap(self, token):
+        """Make token that of the current thread and return the previous
+        one."""
+        previous = getattr(self._local, "token", None)
+        self._local.token = token
+        return previous
+
+    def _token(self):
+        return getattr(self._local, "token", None) or self.default
+
+    def cancel(self):
+        self._token().cancel()
+
+    @property
+    def expired(self):
+        return self._token().expired
+
+    @property
+    def cancelled(self):
+        return self._token().cancelled
+
+    def remaining(self):
+        return self._token().remaining()
+
+    def check(self):
+        self._token().check()
+
+    def __getattr__(self, name):
+        return getattr(self._token(), name)
+
+def shlex_split(line):
+    """Split a line using `shlex.split', removing null characters."""
+    import shlex
+    return [arg.replace("\0", "") for arg in shlex.split(line)]
+
+_SPECIAL_CHARS = re.compile(r"""['"\\]""")
+_UNQUOTED_TOKEN = re.compile(r"[^ \t\r\n]+")
+_TOKEN = re.compile(r"""
+    ((?:[^ \t\r\n'"\\]+         # unquoted characters
+      | '[^']*'                 # single-quoted string
+      | "(?:[^"\\]|\\.)*"       # double-quoted string
+      | \\.                     # escaped character
+     )+)
+    | [ \t\r\n]+                # token separator
+    | (.)                       # unterminated quote or escape
+    """, re.DOTALL | re.VERBOSE)
+_TOKEN_PART = re.compile(r"""'([^']*)'|"((?:[^"\\]|\\.)*)"|\\(.)""",
+                         re.DOTALL)
+_DOUBLE_QUOTE_ESCAPE = re.compile(r'\\(["\\])')
+_UNTERMINATED_DOUBLE_QUOTE = re.compile(r'"(?:[^"\\]|\\.)*\\\Z', re.DOTALL)
+
+def _unquote(match):
+    single, double, escaped = match.groups()
+    if single is not None:
+        return single
+    elif double is not None:
+        return _DOUBLE_QUOTE_ESCAPE.sub(r"\1", double)
+    else:
+        return escaped
+
+def fast_split(line):
+    """Split a line exactly as `shlex_split' does, but faster.
+
+    Lines without quotes or escapes are split on whitespace directly; other
+    lines are tokenized by a precompiled regex implementing the POSIX quoting
+    rules of `shlex'.
+    """
+    if not _SPECIAL_CHARS.search(line):
+        tokens = _UNQUOTED_TOKEN.findall(line)
+    else:
+        tokens = []
+        for match in _TOKEN.finditer(line):
+            token, error = match.groups()
+            if error is not None:
+                if (error == "\\" or error == '"' and
+                    _UNTERMINATED_DOUBLE_QUOTE.match(line, match.start())):
+                    raise ValueError("No escaped character")
+                raise ValueError("No closing quotation")
+            if token is not None:
+                if _SPECIAL_CHARS.search(token):
+                    token = _TOKEN_PART.sub(_unquote, token)
+                tokens.append(token)
+    if "\0" in line:
+        tokens = [token.replace("\0", "") for token in tokens]
+    return tokens
+
+def _unwrap(func):
+    """Follow the `__wrapped__' chain as described in the module docstring."""
+    while (hasattr(func, "__wrapped__") and
+           not getattr(func, USE_MY_ANNOTATIONS, None)):
+        func = func.__wrapped__
+    return func
+
+_ARGFILE_TOKEN = re.compile(br"\S+")
+
+def _open_argfile(path, chunk_size=2 ** 16):
+    """Open the file at path and return an iterator over its
+    whitespace-separated tokens.
+
+    The file is memory-mapped if possible, and otherwise (e.g. for pipes)
+    read in chunks, so that it is never loaded in memory at once."""
+    import mmap
+    file = open(path, "rb")
+    try:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError): # empty or not mappable
+        return _read_argfile(file, chunk_size)
+    file.close()
+    return _decode_tokens(match.group()
+                          for match in _ARGFILE_TOKEN.finditer(data))
+
+def _read_argfile(file, chunk_size):
+    """Yield the tokens of a file, read in chunks, then close it."""
+    with file:
+        tail = b""
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            tokens = (tail + chunk).split()
+            # the last token may continue in the next chunk
+            tail = tokens.pop() if tokens and not chunk[-1:].isspace() else b""
+            for token in _decode_tokens(tokens):
+                yield token
+        if tail:
+            for token in _decode_tokens([tail]):
+                yield token
+
+def _decode_tokens(tokens):
+    """Decode tokens read from a file as UTF-8 (on Python 3)."""
+    if bytes is str:
+        return iter(tokens)
+    return (token.decode("utf-8") for token in tokens)
+
+def _checked_tokens(tokens, arg, varname, cast):
+    """Yield tokens from an argument file streamed to a lazy `many'
+    parameter, raising `CastError' if they cannot be decoded."""
+    try:
+        for token in tokens:
+            yield token
+    except UnicodeDecodeError as exc:
+        raise CastError(varname, arg, cast, "Cannot decode {0}: {1}".format(
+            arg, exc))
+
+def _split_pipeline(line, symbol):
+    """Split line at the unquoted tokens equal to symbol.
+
+    The line is returned unsplit if it cannot be tokenized."""
+    stages = []
+    start = 0
+    for match in _TOKEN.finditer(line):
+        token, error = match.groups()
+        if error is not None:
+            return [line]
+        if token == symbol:
+            stages.append(line[start:match.start()])
+            start = match.end()
+    stages.append(line[start:])
+    return stages
+
+def _as_items(result):
+    """Return the items passed down a pipeline by the result of a command."""
+    if result is None:
+        return ()
+    if isinstance(result, (basestring, bytes)):
+        return (result,)
+    try:
+        return iter(result)
+    except TypeError:
+        return (result,)
+
+def _write_items(result, output):
+    """Write the items of the result of a command to output, one per line, if
+    it is an iterable other than a string or an awaitable (such as the task
+    of a coroutine command), as the last stage of a pipeline does, and return
+    None; otherwise, return result."""
+    if (result is None or isinstance(result, (bool, basestring, bytes)) or
+        hasattr(result, "__await__")):
+        return result
+    try:
+        items = iter(result)
+    except TypeError:
+        return result
+    for item in items:
+        output.write("{0}\n".format(item))
+    return None
+
+def _jsonable(value):
+    """Return value if it can be represented in JSON, or its repr."""
+    if value is None or isinstance(value, (basestring, bool, int, float)):
+        return value
+    return repr(value)
+
+def _complete_value(cast, text):
+    """Return the completions of text offered by a caster.
+
+    A caster can provide completions through its `completions' attribute,
+    either a list of values or a function mapping text to a list of
+    completions."""
+    completions = getattr(cast, "completions", None)
+    if completions is None:
+        return []
+    elif callable(completions):
+        return list(completions(text))
+    else:
+        return [value for value in completions if value.startswith(text)]
+
+def _cast_all(cast, values, varname):
+    """Cast a sequence of values, using the `bulk' attribute of cast if any.
+
+    Raise ArgListError(None, cast_error_args) on failure, naming the failing
+    element as `varname[index]'."""
+    bulk = getattr(cast, "bulk", None)
+    try:
+        return bulk(values) if bulk is not None else list(map(cast, values))
+    except Exception:
+        pass
+    # find the failing element
+    cast_values = []
+    for i, value in enumerate(values):
+        try:
+            cast_values.append(cast(value))
+        except Exception as exc:
+            raise ArgListError(
+                None, ("{0}[{1}]".format(varname, i), value, cast, str(exc)))
+    return cast_values
+
+class _Binding(object):
+    """Binding plan of a `do_*' method.
+
+    The signature of the method (after unwrapping) is introspected once, and
+    the resulting layout is used to bind and cast argument lists without going
+    through `inspect' again.
+    """
+
+    def __init__(self, func, inner_func=None):
+        if inner_func is None:
+            inner_func = _unwrap(func)
+        self.func = getattr(func, "__func__", func)
+        self.inner_func = getattr(inner_func, "__func__", inner_func)
+        # getcallargs implicitly passes self to bound methods, in which case
+        # it does not appear in the argument list reported to bind_error.
+        self.implicit_self = inspect.ismethod(inner_func)
+        self.gets_raw = bool(getattr(inner_func, GETS_RAW, None))
+        self._usages = {}
+        if self.gets_raw:
+            return
+        argspec = getfullargspec(self.inner_func)
+        self.argspec = argspec
+        self.args = list(argspec.args)
+        self.kw_args = (self.args[-len(argspec.defaults):]
+                        if argspec.defaults else [])
+        self.pos_args = self.args[:len(self.args) - len(self.kw_args)]
+        self.defaults = dict(zip(self.kw_args, argspec.defaults or ()))
+        self.kwonlyargs = list(argspec.kwonlyargs)
+        self.kwonlydefaults = dict(argspec.kwonlydefaults or {})
+        self.varargs = argspec.varargs
+        self.varkw = argspec.varkw
+        self.kwonly_complete = all(kw in self.kwonlydefaults
+                                   for kw in self.kwonlyargs)
+        casters = []
+        self.rest = None
+        for varname in (self.args + [self.varargs, self.varkw] +
+                        self.kwonlyargs):
+            if varname is None:
+                continue
+            cast = get_caster(argspec.annotations.get(varname))
+            if isinstance(cast, many):
+                if (varname != self.args[-1] or len(self.args) < 2 or
+                    varname in self.defaults or self.varargs):
+                    raise TypeError(
+                        "many() can only annotate the last positional "
+                        "parameter, without a default, of a method without "
+                        "*args")
+                self.rest = varname
+            if callable(cast):
+                casters.append((varname, cast))
+        self.casters = casters
+        self.caster_of = dict(casters)
+        self.options = sorted(self.kwonlydefaults)
+
+    @classmethod
+    def from_signature(cls, cmd, signature):
+        """Build a binding from the description of a command (see
+        `ParsedCmd.command_signatures'), usable for help and completion only.
+        """
+        self = cls.__new__(cls)
+        self.func = self.inner_func = None
+        self.gets_raw = signature["gets_raw"]
+        self._usages = {cmd: signature["usage"]}
+        if self.gets_raw:
+            return self
+        parameters = dict(((parameter["kind"], parameter["name"]), parameter)
+                          for parameter in signature["parameters"])
+        names = dict((kind, [name for kind_, name in parameters
+                             if kind_ == kind])
+                     for kind in ["positional", "optional", "option",
+                                  "varargs", "varkw"])
+        self.pos_args = ["self"] + names["positional"]
+        self.kw_args = names["optional"]
+        self.args = self.pos_args + self.kw_args
+        self.defaults = dict((name, parameters["optional", name]["default"])
+                             for name in self.kw_args)
+        self.kwonlyargs = names["option"]
+        self.kwonlydefaults = dict(
+            (name, parameters["option", name]["default"])
+            for name in self.kwonlyargs
+            if "default" in parameters["option", name])
+        self.varargs = (names["varargs"] or [None])[0]
+        self.varkw = (names["varkw"] or [None])[0]
+        self.rest = None
+        self.casters = []
+        self.caster_of = dict(
+            (name, Caster(str, completions=parameter["completions"]))
+            for (kind, name), parameter in parameters.items()
+            if "completions" in parameter)
+        self.options = sorted(self.kwonlydefaults)
+        return self
+
+    def parse_options(self, args):
+        """Split initial `-opt val' pairs from args.
+
+        Return the remaining arguments and the keyword-only arguments."""
+        kw_only = self.kwonlydefaults.copy()
+        # args = ["--kw", opt, "--kw", opt, ..., val, val...]
+        # -> args = [val, val, ...]
+        # -> opts = {"kw": opt, "kw": opt, ...}
+        i = 0
+        while i < len(args) and isinstance(args[i], basestring):
+            kw = args[i].lstrip("-")
+            if kw not in kw_only:
+                break
+            if i + 1 == len(args):
+                raise ArgListError(None,
+                                   (args[i:], "Value not given for option."))
+            kw_only[kw] = args[i + 1]
+            i += 2
+        return args[i:], kw_only
+
+    def bind(self, obj, args, kw_only, rest=None):
+        """Bind args (not including obj) and kw_only to the signature.
+
+        rest, if given, is an iterable of further arguments, which are passed
+        lazily to the `many' parameter."""
+        if self.rest is not None and len(args) >= len(self.args) - 2:
+            # the `many' parameter collects the remaining arguments
+            tail = args[len(self.args) - 2:]
+            if rest is not None:
+                tail = itertools.chain(tail, rest)
+            args = args[:len(self.args) - 2] + [tail]
+        positional = [obj] + args
+        num_pos = len(positional)
+        num_args = len(self.args)
+        if (num_pos < len(self.pos_args) or
+            num_pos > num_args and not self.varargs or
+            not self.kwonly_complete):
+            # let getcallargs generate the standard error message
+            callargs = getcallargs(self.inner_func, *positional, **kw_only)
+        else:
+            callargs = dict(zip(self.args, positional))
+            for varname in self.kw_args[num_pos - len(self.pos_args):]:
+                callargs[varname] = self.defaults[varname]
+            if self.varargs:
+                callargs[self.varargs] = tuple(positional[num_args:])
+            if self.varkw:
+                callargs[self.varkw] = {}
+            callargs.update(kw_only)
+        return callargs
+
+    def cast(self, callargs):
+        """Cast the bound values according to the annotations, in place.
+
+        Raise ArgListError(None, cast_error_args) on failure."""
+        for varname, cast in self.casters:
+            bound_val = callargs[varname]
+            if varname == self.varargs:
+                callargs[varname] = _cast_all(cast, bound_val, varname)
+            elif varname == self.rest:
+                callargs[varname] = cast.cast_all(bound_val, varname)
+            elif varname == self.varkw:
+                for key, val in bound_val.items():
+                    try:
+                        bound_val[key] = cast(val)
+                    except Exception as exc:
+                        raise ArgListError(None,
+                                           (varname, val, cast, str(exc)))
+            elif (varname in self.kwonlydefaults and
+                  bound_val == self.kwonlydefaults[varname]):
+                continue # same as given default, keyword-only
+            elif (varname in self.defaults and
+                  bound_val == self.defaults[varname]):
+                continue # same as given default, non-keyword-only
+            else:
+                try:
+                    callargs[varname] = cast(bound_val)
+                except Exception as exc:
+                    raise ArgListError(None,
+                                       (varname, bound_val, cast, str(exc)))
+
+    def complete(self, args, text):
+        """Return the completions of text, following the arguments args."""
+        # skip the options, as parse_options does
+        i = 0
+        given = set()
+        while i < len(args) and args[i].lstrip("-") in self.kwonlydefaults:
+            given.add(args[i].lstrip("-"))
+            if i + 1 == len(args):
+                return _complete_value(
+                    self.caster_of.get(args[i].lstrip("-")), text)
+            i += 2
+        if i == len(args) and text.startswith("-"):
+            kw = text.lstrip("-")
+            dashes = text[:len(text) - len(kw)]
+            return [dashes + option for option in self.options
+                    if option.startswith(kw) and option not in given]
+        position = len(args) - i + 1 # account for self
+        if position < len(self.args):
+            varname = self.args[position]
+        elif self.varargs or self.rest:
+            varname = self.varargs or self.rest
+        else:
+            return []
+        return _complete_value(self.caster_of.get(varname), text)
+
+    def usage(self, cmd):
+        """Return the usage line of the method when called as cmd, or None
+        if it is `@gets_raw'ed."""
+        if self.gets_raw:
+            return None
+        usage = self._usages.get(cmd)
+        if usage is None:
+            usage = "\t" + cmd
+            for arg, default in self.kwonlydefaults.items():
+                metavar = getattr(self.caster_of.get(arg), "metavar", None)
+                usage += " [-{0} {1}(={2})]".format(
+                    arg, metavar or arg[0].upper(), default)
+            for arg in self.kw_args:
+                usage += " [{0}(={1})]".format(
+                    arg.upper(), self.defaults[arg])
+            for arg in self.pos_args[1:]:
+                usage += (" [{0}]" if arg == self.rest else " {0}").format(
+                    arg.upper())
+            if self.varargs:
+                usage += " [{0}]".format(self.varargs.upper())
+            self._usages[cmd] = usage
+        return usage
+
+    def describe(self, cmd):
+        """Return a JSON-compatible description of the method, as documented
+        in `ParsedCmd.command_signatures'."""
+        description = {"doc": inspect.getdoc(self.func),
+                       "gets_raw": self.gets_raw,
+                       "usage": self.usage(cmd),
+                       "parameters": None}
+        if self.gets_raw:
+            return description
+        parameters = []
+        def add(varname, kind, *default):
+            parameter = {"name": varname, "kind": kind}
+            if default:
+                parameter["default"] = _jsonable(default[0])
+            if varname in self.caster_of:
+                cast = self.caster_of[varname]
+                parameter["caster"] = getattr(cast, "__name__", repr(cast))
+                completions = getattr(cast, "completions", None)
+                if isinstance(completions, list):
+                    parameter["completions"] = completions
+            parameters.append(parameter)
+        for varname in self.pos_args[1:]:
+            add(varname, "positional")
+        for varname in self.kw_args:
+            add(varname, "optional", self.defaults[varname])
+        if self.varargs:
+            add(self.varargs, "varargs")
+        for varname in self.kwonlyargs:
+            if varname in self.kwonlydefaults:
+                add(varname, "option", self.kwonlydefaults[varname])
+            else:
+                add(varname, "option")
+        if self.varkw:
+            add(self.varkw, "varkw")
+        description["parameters"] = parameters
+        return description
+
+    def assemble(self, callargs):
+        """Reconstruct the argument list, including obj, from callargs."""
+        args = [callargs[varname] for varname in self.pos_args]
+        if self.varargs:
+            args.extend(callargs[self.varargs])
+        kwargs = dict((varname, callargs[varname])
+                      for varname in self.kw_args + self.kwonlyargs)
+        if self.varkw:
+            kwargs.update(callargs[self.varkw])
+        return args, kwargs
+
+class BufferedOutput(object):
+    """File-like object batching the writes of commands to stream.
+
+    `ParsedCmd.onecmd' (and `main' and `aonecmd') mark the beginning and the
+    end of each command.  Writes made while a command runs are accumulated
+    and passed on in one write, depending on the flush policy:
+
+    - "command": when the command ends (and then the stream is flushed), or
+      when size characters are pending;
+    - "size": only when size characters are pending, or on `flush';
+    - "immediate": at once, flushing the stream after each write.
+
+    Writes made outside of a command (e.g., the intro and the prompt of
+    `cmdloop') are passed on at once, after any pending output.  While
+    `cmdloop' runs, pending output is also written at the end of each
+    command whatever the policy, so that the prompt follows it.
+    """
+
+    POLICIES = ("command", "size", "immediate")
+
+    def __init__(self, stream, flush="command", size=65536):
+        if flush not in self.POLICIES:
+            raise ValueError("Unknown flush policy: {0!r}".format(flush))
+        self.stream = stream
+        self.policy = flush
+        self.size = size
+        self.interactive = False
+        self.encoding = getattr(stream, "encoding", None) or "utf-8"
+        self._chunks = []
+        self._pending = 0
+        self._depth = 0
+
+    @property
+    def in_command(self):
+        """Whether a command is running."""
+        return self._depth > 0
+
+    def write(self, data):
+        if self._depth and self.policy != "immediate":
+            self._chunks.append(data)
+            self._pending += len(data)
+            if self._pending >= self.size:
+                self._write_pending()
+        else:
+            if self._chunks:
+                self._write_pending()
+            self.stream.write(data)
+            if self.policy == "immediate":
+                self.stream.flush()
+
+    def writelines(self, lines):
+        """Write an iterable of strings, in a single write if buffering."""
+        if self._depth and self.policy != "immediate":
+            lines = list(lines)
+            self._chunks.extend(lines)
+            self._pending += sum(map(len, lines))
+            if self._pending >= self.size:
+                self._write_pending()
+        else:
+            self.write("".join(lines))
+
+    def write_bytes(self, data):
+        """Write bytes, decoded with the encoding of the stream."""
+        self.write(data.decode(self.encoding, "replace"))
+
+    def flush(self):
+        if self._chunks:
+            self._write_pending()
+        self.stream.flush()
+
+    def begin_command(self):
+        """Mark the beginning of a command."""
+        self._depth += 1
+
+    def end_command(self):
+        """Mark the end of a command, flushing according to the policy."""
+        self._depth -= 1
+        if not self._depth and (self.policy != "size" or self.interactive):
+            self.flush()
+
+    def _write_pending(self):
+        self.stream.write("".join(self._chunks))
+        self._chunks = []
+        self._pending = 0
+
+class _TeeOutput(object):
+    """File-like object writing to a stream (if not None) and recording what
+    is written."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(data)
+        if self.stream is not None:
+            self.stream.write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self.stream is not None:
+            self.stream.flush()
+
+    def getvalue(self):
+        return "".join(self._chunks)
+
+class _ThreadOutput(object):
+    """File-like object that redirects the writes of threads which called
+    `capture' until they call `release'."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        import threading
+        self._local = threading.local()
+
+    def capture(self):
+        self._local.chunks = []
+
+    def record(self):
+        """Start recording what the current thread writes (nestable)."""
+        records = getattr(self._local, "records", None)
+        if records is None:
+            records = self._local.records = []
+        records.append([])
+
+    def stop_recording(self):
+        """Stop the innermost recording of the current thread and return what
+        it recorded."""
+        return "".join(self._local.records.pop())
+
+    def release(self):
+        chunks = self._local.chunks
+        self._local.chunks = None
+        return "".join(chunks)
+
+    def write(self, data):
+        for record in getattr(self._local, "records", ()):
+            record.append(data)
+        chunks = getattr(self._local, "chunks", None)
+        if chunks is None:
+            self.stream.write(data)
+        else:
+            chunks.append(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self.stream.flush()
+
+class _Completed(object):
+    """Stand-in for a future whose result is already known."""
+
+    def __init__(self, result):
+        self._result = result
+
+    def result(self):
+        return self._result
+
+    def cancel(self):
+        return False
+
+    def cancelled(self):
+        return False
+
+    def exception(self):
+        return None
+
+def _call_captured(obj, output, cmd, func, args, kwargs):
+    """Call func, the command cmd of the ParsedCmd obj, as `ParsedCmd._call'
+    does but running coroutines in a new event loop, capturing what the
+    current thread writes to output.
+
+    Return an (output, status, detail) triple."""
+    output.capture()
+    try:
+        stop = obj._bare_result(
+            obj._call(cmd, func, args, kwargs, _run_coroutine))
+    except CastError as exc:
+        obj.cast_error(*exc.args)
+        return output.release(), ScriptResult.CAST_ERROR, exc.args[-1]
+    except CommandCancelled as exc:
+        obj.cancel_error(*exc.args)
+        return output.release(), ScriptResult.CANCELLED, exc
+    except Exception as exc:
+        return output.release(), ScriptResult.EXCEPTION, exc
+    text = output.release()
+    return text, (ScriptResult.STOP if stop else ScriptResult.OK), None
+
+def _status_hook(hook, status, statuses):
+    """Wrap a hook so that it appends status to statuses when called."""
+    def wrapper(*args):
+        statuses.append(status)
+        return hook(*args)
+    return wrapper
+
+def _copy_in_process(cls, state):
+    """Reconstruct a copy of a ParsedCmd, in a worker process."""
+    obj = cls.__new__(cls)
+    obj.__dict__.update(state)
+    obj.stdout = _ThreadOutput(None)
+    return obj
+
+def _call_in_process(cls, state, cmd, args, kwargs):
+    """Call the command cmd of a copy of a ParsedCmd, in a worker process."""
+    obj = _copy_in_process(cls, state)
+    return _call_captured(
+        obj, obj.stdout, cmd, getattr(obj, "do_" + cmd), args, kwargs)
+
+def _default_max_pending():
+    """Return the default number of lines or chunks that scripts submit to an
+    executor ahead of collecting their results: four per CPU."""
+    try:
+        from os import cpu_count
+    except ImportError: # Python 2.
+        from multiprocessing import cpu_count
+    return 4 * (cpu_count() or 1)
+
+def _materialize(values):
+    """Return a list of values where iterators (lazy `many' arguments) are
+    replaced by iterators over lists, which can be pickled."""
+    return [iter(list(value)) if _is_iterator(value) else value
+            for value in values]
+
+def _validate_in_process(cls, state, start, lines):
+    """Validate lines on a copy of a ParsedCmd, in a worker process."""
+    return _copy_in_process(cls, state)._validate_lines(start, lines)
+
+class ScriptResult(object):
+    """Summary of a `ParsedCmd.run_script' call.
+
+    `statuses' holds one status code per line that was run, and `errors' a
+    list of (lineno, status, detail) triples for failed lines, where detail is
+    the bind or cast error message, the exception raised, the unknown line,
+    or the `CommandCancelled' exception of a command that was cancelled.
+    """
+
+    (OK, STOP, SKIPPED, UNKNOWN, BIND_ERROR, CAST_ERROR, EXCEPTION,
+     CANCELLED) = range(8)
+
+    def __init__(self):
+        self.statuses = bytearray()
+        self.errors = []
+        self.stopped = False
+
+    def add(self, lineno, status, detail):
+        self.statuses.append(status)
+        if status == self.STOP:
+            self.stopped = True
+        elif status > self.SKIPPED:
+            self.errors.append((lineno, status, detail))
+
+    def extend(self, other):
+        """Append the statuses and errors of another result."""
+        self.statuses.extend(other.statuses)
+        self.errors.extend(other.errors)
+        self.stopped = self.stopped or other.stopped
+
+    def stop(self, status, stop_on_error):
+        """Whether a script should stop after a line with the given status."""
+        return (status == self.STOP or
+                stop_on_error and status > self.SKIPPED)
+
+    @property
+    def ok(self):
+        """Whether all lines ran without errors."""
+        return not self.errors
+
+    @property
+    def error_lines(self):
+        """The line numbers of the failed lines."""
+        return [lineno for lineno, status, detail in self.errors]
+
+    def __len__(self):
+        return len(self.statuses)
+
+    def __repr__(self):
+        return "<ScriptResult: {0} lines, {1} errors>".format(
+            len(self), len(self.errors))
+
+class CommandStat(object):
+    """Statistics of a command.
+
+    `times' maps each phase ("split", "bind", "cast", "run") to the total
+    time spent in it, and `histogram[i]' counts the successful calls whose
+    total latency was less than 2 ** i microseconds (but not less than
+    2 ** (i - 1)).
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.bind_errors = 0
+        self.cast_errors = 0
+        self.exceptions = 0
+        self.times = dict.fromkeys(CommandStats.PHASES, 0.)
+        self.histogram = []
+
+    @property
+    def errors(self):
+        return self.bind_errors + self.cast_errors + self.exceptions
+
+class CommandStats(object):
+    """Per-command statistics recorded by `ParsedCmd.onecmd'.
+
+    `commands' maps command names to `CommandStat' instances.
+    """
+
+    PHASES = ("split", "bind", "cast", "run")
+
+    def __init__(self):
+        self.commands = {}
+
+    def record(self, cmd, timings, error=None):
+        """Record a call to cmd.
+
+        timings lists the times spent in the phases that were run, and error
+        is None, "bind_error", "cast_error" or "exception".
+        """
+        stat = self.commands.get(cmd)
+        if stat is None:
+            stat = self.commands[cmd] = CommandStat()
+        stat.calls += 1
+        for phase, timing in zip(self.PHASES, timings):
+            stat.times[phase] += timing
+        if error is None:
+            bucket = int(sum(timings) * 1e6).bit_length()
+            histogram = stat.histogram
+            if bucket >= len(histogram):
+                histogram.extend([0] * (bucket + 1 - len(histogram)))
+            histogram[bucket] += 1
+        else:
+            setattr(stat, error + "s", getattr(stat, error + "s") + 1)
+
+    def reset(self):
+        """Forget all statistics."""
+        self.commands.clear()
+
+    def format(self, cmds=None, histogram=False):
+        """Format the statistics of cmds (by default, all commands) as a
+        table of call and error counts, and mean times per phase, in
+        microseconds."""
+        if cmds is None:
+            cmds = sorted(self.commands)
+        lines = ["{0:<16}{1:>8}{2:>8}{3:>8}{4:>8}{5:>10}{6:>10}{7:>10}{8:>10}"
+                 .format("command", "calls", "bind", "cast", "exc",
+                         *self.PHASES)]
+        for cmd in cmds:
+            stat = self.commands.get(cmd, CommandStat())
+            means = [stat.times[phase] / stat.calls * 1e6 if stat.calls
+                     else 0. for phase in self.PHASES]
+            lines.append(
+                "{0:<16}{1:>8}{2:>8}{3:>8}{4:>8}"
+                "{5:>10.1f}{6:>10.1f}{7:>10.1f}{8:>10.1f}".format(
+                    cmd, stat.calls, stat.bind_errors, stat.cast_errors,
+                    stat.exceptions, *means))
+            if histogram:
+                for bucket, count in enumerate(stat.histogram):
+                    if count:
+                        lines.append("    < {0:>10} us: {1}".format(
+                            2 ** bucket, count))
+        return "\n".join(lines) + "\n"
+
+def stats_command(self, *args):
+    """Show or reset the command statistics.
+
+    `stats [show] [CMD...]' shows the statistics of all commands, or of the
+    given commands together with their latency histograms; `stats reset'
+    forgets them.
+    """
+    action = args[0] if args else "show"
+    if self.stats is None:
+        self.stdout.write("*** Statistics are not enabled.\n")
+    elif action == "reset" and len(args) == 1:
+        self.stats.reset()
+    elif action == "show" or action in self.stats.commands:
+        cmds = args[1:] if action == "show" else args
+        self.stdout.write(self.stats.format(cmds or None, bool(cmds)))
+    else:
+        self.stdout.write("*** Unknown action: {0}\n".format(action))
+
+# Kinds of command log entries: a line dispatched through onecmd, a command
+# with its raw argument (`@gets_raw'), or a command with its split arguments.
+_LOG_LINE, _LOG_RAW, _LOG_ARGV = range(3)
+# The hooks through which the outcome of a logged line is reported, and the
+# corresponding statuses.
+_LOG_HOOKS = [("default", ScriptResult.UNKNOWN),
+              ("bind_error", ScriptResult.BIND_ERROR),
+              ("cast_error", ScriptResult.CAST_ERROR),
+              ("cancel_error", ScriptResult.CANCELLED)]
+# Entry header: entry size, timestamp, kind, status, output CRC-32 and length,
+# number of strings (each of them prefixed by its length).
+_LOG_HEADER = "<IdBBIII"
+_LOG_LENGTH = "<I"
+
+LogEntry = namedtuple("LogEntry",
+                      "timestamp kind status crc length strings")
+
+class CommandRecorder(object):
+    """Append-only binary log of the lines dispatched by `onecmd'.
+
+    Assigning a recorder to the `recorder' attribute of a ParsedCmd makes
+    `onecmd' log each line with its timestamp, status (a `ScriptResult'
+    status code), the CRC-32 and length of its output and, for commands, the
+    already split arguments; `ParsedCmd.replay' replays such a log.  file is
+    a path (opened for appending) or a binary file object.
+    """
+
+    MAGIC = b"PCMDLOG\x01"
+
+    def __init__(self, file):
+        import struct
+        self._header = struct.Struct(_LOG_HEADER)
+        self._length = struct.Struct(_LOG_LENGTH)
+        if isinstance(file, basestring):
+            file = open(file, "ab")
+        self.file = file
+        if file.tell() == 0:
+            file.write(self.MAGIC)
+
+    def record(self, timestamp, kind, status, output, strings):
+        """Append an entry for a line, given the `_TeeOutput' that recorded
+        its output."""
+        encoded = [string.encode("utf-8") for string in strings]
+        parts = []
+        for data in encoded:
+            parts.append(self._length.pack(len(data)))
+            parts.append(data)
+        body = b"".join(parts)
+        crc, length = _checksum(output)
+        self.file.write(self._header.pack(
+            self._header.size + len(body), timestamp, kind, status, crc,
+            length, len(encoded)) + body)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @classmethod
+    def read(cls, path):
+        """Iterate over the `LogEntry's of a log, which is memory-mapped.
+
+        A truncated last entry (e.g. if the recording process crashed) is
+        ignored."""
+        import mmap
+        import struct
+        header = struct.Struct(_LOG_HEADER)
+        length = struct.Struct(_LOG_LENGTH)
+        with open(path, "rb") as file:
+            try:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError: # empty
+                return
+        if data[:len(cls.MAGIC)] != cls.MAGIC:
+            raise ValueError("{0} is not a command log.".format(path))
+        offset = len(cls.MAGIC)
+        while offset + header.size <= len(data):
+            size, timestamp, kind, status, crc, output_length, count = (
+                header.unpack_from(data, offset))
+            if offset + size > len(data):
+                break
+            position = offset + header.size
+            strings = []
+            for _ in range(count):
+                string_length, = length.unpack_from(data, position)
+                position += length.size
+                strings.append(
+                    data[position:position + string_length].decode("utf-8"))
+                position += string_length
+            yield LogEntry(timestamp, kind, status, crc, output_length,
+                           strings)
+            offset += size
+
+def _checksum(output):
+    """Return the CRC-32 and the length of the UTF-8 encoding of what was
+    written to a `_TeeOutput'."""
+    import zlib
+    data = output.getvalue()
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    return zlib.crc32(data) & 0xffffffff, len(data)
+
+class ReplayResult(object):
+    """Summary of a `ParsedCmd.replay' call.
+
+    `divergences' is a list of (index, line, expected, actual) tuples for
+    the entries whose outcome differs from the recorded one, where expected
+    and actual are (status, output CRC-32, output length) triples.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.divergences = []
+
+    def add(self, entry, status, output):
+        expected = (entry.status, entry.crc, entry.length)
+        actual = (status,) + _checksum(output)
+        if actual != expected:
+            self.divergences.append(
+                (self.count, entry.strings[0], expected, actual))
+        self.count += 1
+
+    @property
+    def ok(self):
+        """Whether all entries were replayed with the recorded outcome."""
+        return not self.divergences
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return "<ReplayResult: {0} entries, {1} divergences>".format(
+            self.count, len(self.divergences))
+
+def _run_coroutine(result):
+    """Run result to completion in a new event loop if it is a coroutine."""
+    if iscoroutine(result):
+        import asyncio
+        return asyncio.run(result)
+    return result
+
+if sys.version_info >= (3, 7):
+    from _parsedcmd_async import AsyncCmdMixin as _AsyncCmdMixin, CmdServer
+    __all__.append("CmdServer")
+else:
+    _AsyncCmdMixin = object
+
+class _CommandSetMeta(type):
+    """Metaclass counting the changes to the command sets of its classes.
+
+    `version' is incremented whenever a `do_*' or `help_*' attribute of such
+    a class is set or deleted after the class is created, so that indexes
+    built from the command set of a class (and its subclasses) only need to
+    compare versions to be invalidated."""
+
+    version = 0
+
+    def __setattr__(cls, name, value):
+        type.__setattr__(cls, name, value)
+        if name.startswith(("do_", "help_")):
+            _CommandSetMeta.version += 1
+
+    def __delattr__(cls, name):
+        type.__delattr__(cls, name)
+        if name.startswith(("do_", "help_")):
+            _CommandSetMeta.version += 1
+
+# (called directly, as the syntax for metaclasses differs between Pythons)
+_ParsedCmdBase = _CommandSetMeta(
+    "_ParsedCmdBase", (Cmd, _AsyncCmdMixin), {"__slots__": ()})
+
+class ParsedCmd(_ParsedCmdBase):
     """An subclass of cmd.Cmd that can parse arguments."""
 
+    # Set to False to introspect `do_*' methods on every call instead of using
+    # the per-class table of compiled bindings.
+    compile_bindings = True
+    # The function used by `split'; `shlex_split' is the reference
+    # implementation.
+    tokenizer = staticmethod(fast_split)
+    # The event loop in which coroutine `do_*' methods are run when onecmd is
+    # called outside of a running loop, created as needed.
+    _event_loop = None
+    # A CommandStats instance in which onecmd records statistics, or None.
+    stats = None
+    # If set (e.g. to "@"), positional arguments starting with this prefix are
+    # replaced by the whitespace-separated tokens of the named file.
+    argfile_prefix = None
+    # If set (e.g. to "|"), lines are split into pipelines at the unquoted
+    # tokens equal to this symbol.
+    pipe_symbol = None
+    # A CommandRecorder to which onecmd logs each line, or None.
+    recorder = None
+    # An (arg, tokens) pair, set while replaying a logged line, so that split
+    # returns tokens for arg instead of splitting it again.
+    _presplit = None
+    # If set to a flush policy of BufferedOutput ("command", "size" or
+    # "immediate"), the constructor wraps stdout in a BufferedOutput.
+    buffer_output = None
+    # The deadline of each command, in seconds (overridden by `@timeout'), or
+    # None.
+    command_timeout = None
+    # The `CancelToken' of the running command.
+    cancel_token = _NeverCancelled()
+
     def __init__(self, **kwargs):
         show_usage = kwargs.pop("show_usage", False)
+        stats = kwargs.pop("stats", False)
+        argfile_prefix = kwargs.pop("argfile_prefix", None)
+        pipe_symbol = kwargs.pop("pipe_symbol", None)
+        recorder = kwargs.pop("recorder", None)
+        buffer_output = kwargs.pop("buffer_output", self.buffer_output)
+        command_timeout = kwargs.pop("command_timeout", None)
         Cmd.__init__(self, **kwargs)
+        if command_timeout is not None:
+            self.command_timeout = command_timeout
+        if buffer_output is not None:
+            self.stdout = BufferedOutput(self.stdout, buffer_output)
         self.show_usage = show_usage
+        if stats:
+            self.stats = CommandStats()
+        if argfile_prefix is not None:
+            self.argfile_prefix = argfile_prefix
+        if pipe_symbol is not None:
+            self.pipe_symbol = pipe_symbol
+        if recorder is not None:
+            self.recorder = recorder
+
+    @classmethod
+    def invalidate_bindings(cls):
+        """Drop the compiled bindings of this class.
+
+        This is only needed if a function's signature or annotations are
+        modified in place; adding or replacing `do_*' methods is detected
+        automatically."""
+        cls._bindings = {}
+
+    @classmethod
+    def get_binding(cls, func, inner_func=None):
+        """Return the compiled binding of func, building it if needed."""
+        table = cls.__dict__.get("_bindings")
+        if table is None:
+            table = cls._bindings = {}
+        binding = table.get(getattr(func, "__func__", func))
+        if (binding is None or inner_func is not None and
+            binding.inner_func is not getattr(inner_func, "__func__",
+                                              inner_func)):
+            binding = _Binding(func, inner_func)
+            table[binding.func] = binding
+        return binding
+
+    @classmethod
+    def _class_cached(cls, name, build, extra=()):
+        """Return build(), cached in the class attribute name.
+
+        The value is rebuilt when a `do_*' or `help_*' attribute of the class
+        or its bases is added, removed or replaced (see `_CommandSetMeta'), or
+        when extra changes."""
+        cache = cls.__dict__.get(name)
+        key = (_CommandSetMeta.version, list(extra))
+        if cache is None or cache[0] != key:
+            cache = (key, build())
+            setattr(cls, name, cache)
+        return cache[1]
+
+    @classmethod
+    def register_lazy(cls, name, target, signature=None, doc=None):
+        """Declare the command name, whose `do_*' method is imported from
+        target when first needed (see `LazyCommand')."""
+        setattr(cls, "do_" + name, LazyCommand(target, signature, doc))
+
+    @classmethod
+    def _lazy_command(cls, name):
+        """Return the LazyCommand for attribute name if it is not imported
+        yet, or None."""
+        for klass in cls.__mro__:
+            if name in vars(klass):
+                value = vars(klass)[name]
+                return value if isinstance(value, LazyCommand) else None
+        return None
+
+    @classmethod
+    def command_cache_info(cls):
+        """Return a dict mapping the names of the `@cached' commands to their
+        `CacheInfo'."""
+        info = {}
+        for name in dir(cls):
+            if name.startswith("do_") and cls._lazy_command(name) is None:
+                cached_func = _find_cached(getattr(cls, name))
+                if cached_func is not None:
+                    info[name[3:]] = cached_func.cache_info()
+        return info
+
+    def command_names(self):
+        """Return the sorted list of command names, cached per class."""
+        return self._class_cached(
+            "_command_index",
+            lambda: sorted(set(name[3:] for name in self.get_names()
+                               if name.startswith("do_"))))
+
+    def completenames(self, text, *ignored):
+        names = self.command_names()
+        matches = []
+        for i in range(bisect.bisect_left(names, text), len(names)):
+            if not names[i].startswith(text):
+                break
+            matches.append(names[i])
+        return matches
+
+    def completedefault(self, text, line, begidx, endidx):
+        """Complete the options and arguments of a command according to its
+        signature, and the `completions' attribute of the casters."""
+        cmd, arg, line = self.parseline(line[:begidx])
+        if not cmd:
+            return []
+        lazy = self._lazy_command("do_" + cmd)
+        if lazy is not None and lazy.signature is not None:
+            binding = _Binding.from_signature(cmd, lazy.signature)
+        else:
+            func, inner_func = self._find_command(cmd)
+            if func is None:
+                return []
+            binding = self.get_binding(func)
+        if binding.gets_raw:
+            return []
+        try:
+            args = self.split(arg)
+        except ValueError:
+            return []
+        return binding.complete(args, text)
 
     def onecmd(self, line):
+        output = self.stdout
+        if isinstance(output, BufferedOutput) and not output._depth:
+            output.begin_command()
+            try:
+                return self.onecmd(line)
+            finally:
+                output.end_command()
+        if self.recorder is not None:
+            return self._onecmd_recorded(line)
+        if self.pipe_symbol is not None and self.pipe_symbol in line:
+            stages = self._pipeline_stages(line)
+            if stages is not None:
+                self.lastcmd = line.strip()
+                return self.run_pipeline(stages)
         # initial parsing
         cmd, arg, line = self.parseline(line)
         if not line:
@@ -230,32 +1738,875 @@ class ParsedCmd(Cmd, object):
             return self.default(line)
         self.lastcmd = line
         # find the method to which dispatch
-        if cmd == "":
+        func, inner_func = self._find_command(cmd)
+        if func is None:
             return self.default(line)
+        if self.stats is not None:
+            return self._onecmd_timed(cmd, arg, func, inner_func)
+        try:
+            args, kwargs = self.construct_arglist(arg, func, inner_func)
+        except ArgListError as exc:
+            callback, args = exc.args
+            return callback(*args)
+        try:
+            return self._bare_result(self._call(cmd, func, args, kwargs))
+        except CastError as exc:
+            return self.cast_error(*exc.args)
+        except CommandCancelled as exc:
+            return self.cancel_error(*exc.args)
+    onecmd.__doc__ = Cmd.onecmd.__doc__
+
+    def cmdloop(self, intro=None):
+        output = self.stdout
+        if not isinstance(output, BufferedOutput):
+            return Cmd.cmdloop(self, intro)
+        interactive = output.interactive
+        output.interactive = True
+        try:
+            return Cmd.cmdloop(self, intro)
+        finally:
+            output.interactive = interactive
+            output.flush()
+    cmdloop.__doc__ = Cmd.cmdloop.__doc__
+
+    def _onecmd_recorded(self, line):
+        """onecmd, logging the line and its outcome to `recorder'."""
+        timestamp = time.time()
+        kind, strings = self._log_entry(line)
+        stdout = self.stdout
+        self.stdout = output = _TeeOutput(stdout)
+        status = ScriptResult.EXCEPTION
+        try:
+            status, result = self._run_logged(kind, strings)
+        finally:
+            self.stdout = stdout
+            self.recorder.record(timestamp, kind, status, output, strings)
+        return result
+
+    def _log_entry(self, line):
+        """Return the kind and the strings of the log entry of a line."""
+        cmd, arg, parsed = self.parseline(line)
+        if parsed and cmd is not None and self._pipeline_stages(line) is None:
+            func, inner_func = self._find_command(cmd)
+            if func is not None:
+                if self.get_binding(func, inner_func).gets_raw:
+                    return _LOG_RAW, [parsed, cmd, arg]
+                try:
+                    return _LOG_ARGV, [parsed, cmd] + self.split(arg)
+                except ValueError:
+                    pass
+        return _LOG_LINE, [line]
+
+    def _run_logged(self, kind, strings):
+        """Run a log entry through onecmd, returning its status and result.
+
+        The arguments of an entry with split arguments are passed to `split'
+        instead of being split again.  The status is deduced from the hooks
+        that are called."""
+        line = strings[0]
+        if kind == _LOG_ARGV:
+            # the argument of the parsed line, as parseline returns it
+            self._presplit = (line[len(strings[1]):].strip(), strings[2:])
+        statuses = []
+        hooks = dict((name, _status_hook(getattr(self, name), status,
+                                         statuses))
+                     for name, status in _LOG_HOOKS)
+        instance_dict = self.__dict__
+        saved = dict((name, instance_dict[name])
+                     for name in hooks if name in instance_dict)
+        instance_dict.update(hooks)
+        recorder = self.recorder
+        self.recorder = None
+        try:
+            result = self.onecmd(line)
+        finally:
+            self.recorder = recorder
+            self._presplit = None
+            for name in hooks:
+                del instance_dict[name]
+            instance_dict.update(saved)
+        if statuses:
+            return statuses[0], result
+        return (ScriptResult.STOP if result else ScriptResult.OK), result
+
+    def replay(self, path, paced=False):
+        """Replay a log written by a `CommandRecorder' and return a
+        `ReplayResult'.
+
+        Each entry is dispatched as it was when recorded, except that the
+        arguments of commands are not split again.  The output is discarded,
+        but its checksum and the status of the command are compared with the
+        recorded ones; exceptions raised by commands are recorded as such.
+        Entries are replayed as fast as possible or, if paced is true, with
+        the recorded delays between them.
+        """
+        result = ReplayResult()
+        stdout = self.stdout
+        recorder = self.recorder
+        self.recorder = None
+        first = start = None
+        try:
+            for entry in CommandRecorder.read(path):
+                if paced:
+                    if first is None:
+                        first, start = entry.timestamp, timer()
+                    delay = (entry.timestamp - first) - (timer() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+                self.stdout = output = _TeeOutput(None)
+                try:
+                    status, _ = self._run_logged(entry.kind, entry.strings)
+                except Exception:
+                    status = ScriptResult.EXCEPTION
+                finally:
+                    self.stdout = stdout
+                result.add(entry, status, output)
+        finally:
+            self.stdout = stdout
+            self.recorder = recorder
+        return result
+
+    def run_pipeline(self, stages):
+        """Run a pipeline of commands, as `onecmd' does for lines containing
+        `pipe_symbol'.
+
+        The result of each command is passed to the next one, without being
+        converted to strings: None passes nothing, strings and non-iterable
+        objects are passed as is, and the items of other iterables are passed
+        one by one (lazily, for iterators and generators).  The items are
+        appended to the arguments given on the command line, without being
+        cast, as the `many' parameter or the *args of the next command (which
+        must have one).  If the result of the last command is neither None
+        nor a bool, its items are written to `stdout', one per line, and None
+        is returned; otherwise, it is returned.
+        """
+        return self._run_pipeline(stages)[2]
+
+    def _pipeline_stages(self, line):
+        """Return the stages of line if it is a pipeline, or None.
+
+        A line whose first command is `@gets_raw'ed is not a pipeline, as the
+        raw line is passed unchanged."""
+        if self.pipe_symbol is None or self.pipe_symbol not in line:
+            return None
+        stages = _split_pipeline(line, self.pipe_symbol)
+        if len(stages) == 1:
+            return None
+        cmd = self.parseline(stages[0])[0]
+        if cmd is not None:
+            func, inner_func = self._find_command(cmd)
+            if func is not None and (
+                    self.get_binding(func, inner_func).gets_raw
+                    if self.compile_bindings
+                    else getattr(inner_func, GETS_RAW, None)):
+                return None
+        return stages
+
+    def _run_pipeline(self, stages):
+        """Run a pipeline, returning a (status, detail, result) triple as
+        `_run_line' does, and the result of `run_pipeline'."""
+        items = None
+        for i, stage in enumerate(stages):
+            cmd, arg, line = self.parseline(stage)
+            func, inner_func = (self._find_command(cmd) if cmd is not None
+                                else (None, None))
+            if func is None:
+                return ScriptResult.UNKNOWN, line, self.default(line)
+            try:
+                if items is None:
+                    args, kwargs = self.construct_arglist(
+                        arg, func, inner_func)
+                else:
+                    args, kwargs = self._construct_piped_arglist(
+                        arg, func, inner_func, items)
+            except ArgListError as exc:
+                callback, args = exc.args
+                status = (ScriptResult.CAST_ERROR
+                          if callback.__name__ == "cast_error"
+                          else ScriptResult.BIND_ERROR)
+                return status, args[-1], callback(*args)
+            try:
+                result = self._call(cmd, func, args, kwargs)
+                items = _as_items(result)
+                if i == len(stages) - 1:
+                    if result is None or isinstance(result, bool):
+                        return ((ScriptResult.STOP if result
+                                 else ScriptResult.OK), None, result)
+                    for item in items:
+                        self.stdout.write("{0}\n".format(item))
+            except CastError as exc:
+                return (ScriptResult.CAST_ERROR, exc.args[-1],
+                        self.cast_error(*exc.args))
+            except CommandCancelled as exc:
+                return (ScriptResult.CANCELLED, exc,
+                        self.cancel_error(*exc.args))
+        return ScriptResult.OK, None, None
+
+    def _construct_piped_arglist(self, arg, func, inner_func, items):
+        """Construct the argument list of a pipeline stage, appending items
+        to its `many' parameter or *args."""
+        binding = self.get_binding(func, inner_func)
+        if binding.gets_raw or not (binding.rest or binding.varargs):
+            raise ArgListError(
+                self.bind_error,
+                (self.split(arg), "This command does not take piped input."))
+        callargs = self._bind_args(binding, self.split(arg))
+        self._cast_args(binding, callargs)
+        if binding.rest is not None:
+            callargs[binding.rest] = binding.caster_of[binding.rest].extend(
+                callargs[binding.rest], items)
+        else:
+            callargs[binding.varargs] = (
+                tuple(callargs[binding.varargs]) + tuple(items))
+        return self._assemble_args(binding, func, callargs)
+
+    def _await(self, coro):
+        """Run a coroutine returned by a `do_*' method.
+
+        Within a running event loop, the coroutine is scheduled as a task,
+        which is returned.  Otherwise, it is run to completion in the event
+        loop of the interpreter, and its result returned.
+        """
+        import asyncio
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            if self._event_loop is None:
+                self._event_loop = asyncio.new_event_loop()
+            return self._event_loop.run_until_complete(coro)
+        return asyncio.ensure_future(coro)
+
+    def _call(self, cmd, func, args, kwargs, run=None):
+        """Call the `do_*' method of cmd, enforcing its deadline, and run it
+        to completion, with run (by default, `_await'), if it returns a
+        coroutine.
+
+        A coroutine with a deadline is cancelled when it passes, which is
+        reported by `cancel_error' (in the task, if one is returned).  Other
+        commands that overrun their deadline without checking their token
+        raise `CommandCancelled' when they return.
+        """
+        # (looked up on the function, as a miss on a bound method is slow)
+        seconds = getattr(getattr(func, "__func__", func), TIMEOUT,
+                          self.command_timeout)
+        if seconds is None:
+            result = func(*args, **kwargs)
+            if iscoroutine(result):
+                result = (run or self._await)(result)
+            return result
+        token = CancelToken(seconds, cmd)
+        saved = self._install_token(token)
+        try:
+            result = func(*args, **kwargs)
+            if iscoroutine(result):
+                result = (run or self._await)(
+                    self._await_deadline(result, token))
+            elif token.expired:
+                raise CommandCancelled(cmd, seconds)
+        finally:
+            self._restore_token(token, saved)
+        return result
+
+    def _install_token(self, token):
+        """Make token the `cancel_token' seen by the current command, and
+        return what `_restore_token' needs to undo it.
+
+        While a script runs commands in threads, `cancel_token' is a
+        `_ThreadCancelToken', and only the current thread is affected."""
+        current = self.cancel_token
+        if isinstance(current, _ThreadCancelToken):
+            return current, current.swap(token)
+        self.cancel_token = token
+        return None, current
+
+    def _restore_token(self, token, saved):
+        """Undo `_install_token(token)', which returned saved."""
+        shared, previous = saved
+        if shared is not None:
+            shared.swap(previous)
+        elif self.cancel_token is token:
+            self.cancel_token = previous
+
+    def _bare_result(self, result):
+        """Return the result of a command run outside of a pipeline.
+
+        When pipelines are enabled, an iterable result is written out as by
+        the last stage of a pipeline (see `_write_items'); otherwise, result
+        is returned unchanged, as by `Cmd.onecmd'.
+        """
+        if self.pipe_symbol is None:
+            return result
+        return _write_items(result, self.stdout)
+
+    def _find_command(self, cmd):
+        """Return the `do_*' method for cmd and its unwrapped version, or
+        (None, None)."""
+        if cmd == "":
+            return None, None
         try:
             func = getattr(self, "do_" + cmd)
         except AttributeError:
-            return self.default(line)
-        inner_func = func
-        while (hasattr(inner_func, "__wrapped__") and
-               not getattr(inner_func, USE_MY_ANNOTATIONS, None)):
-            inner_func = inner_func.__wrapped__
+            return None, None
+        if self.compile_bindings:
+            inner_func = self.get_binding(func).inner_func
+        else:
+            inner_func = _unwrap(func)
+        return func, inner_func
+
+    def main(self, argv=None):
+        """Run the command given by argv (by default, `sys.argv[1:]') and
+        return an exit status, e.g. `sys.exit(UI().main())'.
+
+        As argv has already been split (by the shell), the arguments are not
+        split again, and quotes in them are kept; they are bound and cast as
+        by `construct_arglist' (`@gets_raw' commands get them joined by
+        spaces).  The status is 0 if the command ran, 1 if it was cancelled
+        or timed out (after calling `cancel_error'), and 2 if it is unknown or
+        if its arguments could not be bound or cast (after calling `default',
+        `bind_error' or `cast_error').  Exceptions raised by the command
+        propagate.  Without arguments, `cmdloop' is run instead.
+        """
+        if argv is None:
+            argv = sys.argv[1:]
+        if not argv:
+            self.cmdloop()
+            return 0
+        output = self.stdout
+        if isinstance(output, BufferedOutput) and not output.in_command:
+            output.begin_command()
+            try:
+                return self.main(argv)
+            finally:
+                output.end_command()
+                output.flush()
+        cmd = argv[0]
+        func, inner_func = self._find_command(cmd)
+        if func is None:
+            self.default(" ".join(argv))
+            return 2
+        try:
+            args, kwargs = self.construct_arglist_from_argv(
+                list(argv[1:]), func, inner_func)
+        except ArgListError as exc:
+            callback, args = exc.args
+            callback(*args)
+            return 2
+        try:
+            self._bare_result(self._call(cmd, func, args, kwargs))
+        except CastError as exc:
+            self.cast_error(*exc.args)
+            return 2
+        except CommandCancelled as exc:
+            self.cancel_error(*exc.args)
+            return 1
+        return 0
+
+    def run_script(self, source, stop_on_error=False, executor=None,
+                   max_pending=None):
+        """Run commands non-interactively and return a `ScriptResult'.
+
+        source may be a file name, a file object, or any iterable of lines.
+        Each line is dispatched as by `onecmd', except that empty lines are
+        skipped instead of repeating the last command.  Output written to
+        `self.stdout' is buffered until the script ends.  The script stops
+        when a command returns a true value (as in `cmdloop'), or, if
+        stop_on_error is true, at the first line that fails.
+
+        If executor (a `concurrent.futures.Executor') is given, commands
+        decorated with `@parallel_safe' are submitted to it, after being bound
+        and cast in the calling thread; their output is captured and written
+        in input order.  Other commands wait for all submitted commands to
+        complete before running.  At most max_pending lines (by default, four
+        per CPU) are submitted ahead of the output being written.  When the
+        script stops, commands that were already submitted may still have
+        run, but their output is discarded.
+        """
+        result = ScriptResult()
+        if isinstance(source, basestring):
+            with open(source) as file:
+                return self._run_script(
+                    file, stop_on_error, executor, max_pending, result)
+        else:
+            return self._run_script(
+                source, stop_on_error, executor, max_pending, result)
+
+    def _run_script(self, lines, stop_on_error, executor, max_pending,
+                    result):
+        stdout = self.stdout
+        # The whole script counts as one command, written in large chunks.
+        self.stdout = buffered = BufferedOutput(stdout, "size")
+        buffered.begin_command()
+        try:
+            if executor is None:
+                for lineno, line in enumerate(lines, 1):
+                    status, detail = self._run_line(line)
+                    result.add(lineno, status, detail)
+                    if result.stop(status, stop_on_error):
+                        break
+            else:
+                self.stdout = _ThreadOutput(self.stdout)
+                cancel_token = self.cancel_token
+                self.cancel_token = _ThreadCancelToken(cancel_token)
+                try:
+                    self._run_parallel(
+                        lines, stop_on_error, executor, max_pending, result)
+                finally:
+                    self.cancel_token = cancel_token
+        finally:
+            buffered.end_command()
+            buffered.flush()
+            self.stdout = stdout
+        return result
+
+    def _prepare_line(self, line):
+        """Parse a script line and construct the argument list.
+
+        Return a (status, detail, call) triple, where call is either None if
+        the line has already been handled, or a (cmd, func, inner_func, args,
+        kwargs) tuple.
+        """
+        cmd, arg, line = self.parseline(line)
+        if not line:
+            return ScriptResult.SKIPPED, None, None
+        if cmd is not None:
+            self.lastcmd = line
+            func, inner_func = self._find_command(cmd)
+        if cmd is None or func is None:
+            self.default(line)
+            return ScriptResult.UNKNOWN, line, None
         try:
             args, kwargs = self.construct_arglist(arg, func, inner_func)
         except ArgListError as exc:
             callback, args = exc.args
-            return callback(*args)
-        return func(*args, **kwargs)
-    onecmd.__doc__ = Cmd.onecmd.__doc__
+            callback(*args)
+            if callback.__name__ == "cast_error":
+                return ScriptResult.CAST_ERROR, args[-1], None
+            return ScriptResult.BIND_ERROR, args[-1], None
+        return ScriptResult.OK, None, (cmd, func, inner_func, args, kwargs)
+
+    def _run_line(self, line):
+        """Run a script line, returning a (status, detail) pair."""
+        stages = self._pipeline_stages(line)
+        if stages is not None:
+            return self._run_script_pipeline(line, stages)
+        status, detail, call = self._prepare_line(line)
+        if call is None:
+            return status, detail
+        cmd, func, inner_func, args, kwargs = call
+        try:
+            stop = self._bare_result(self._call(cmd, func, args, kwargs))
+        except CastError as exc:
+            self.cast_error(*exc.args)
+            return ScriptResult.CAST_ERROR, exc.args[-1]
+        except CommandCancelled as exc:
+            self.cancel_error(*exc.args)
+            return ScriptResult.CANCELLED, exc
+        except Exception as exc:
+            return ScriptResult.EXCEPTION, exc
+        return (ScriptResult.STOP if stop else ScriptResult.OK), None
+
+    def _run_script_pipeline(self, line, stages):
+        """Run a script line that is a pipeline, returning a (status, detail)
+        pair."""
+        self.lastcmd = line.strip()
+        try:
+            status, detail, _ = self._run_pipeline(stages)
+        except Exception as exc:
+            return ScriptResult.EXCEPTION, exc
+        return status, detail
+
+    def _run_parallel(self, lines, stop_on_error, executor, max_pending,
+                      result):
+        """Run a script, submitting `@parallel_safe' commands to executor."""
+        from concurrent.futures import ProcessPoolExecutor
+        in_process = isinstance(executor, ProcessPoolExecutor)
+        state = None
+        window = max_pending or _default_max_pending()
+        pending = collections.deque()
+
+        def collect(size):
+            """Write the results of pending lines until at most size remain.
+
+            Return whether the script should stop."""
+            while len(pending) > size:
+                lineno, future = pending.popleft()
+                try:
+                    output, status, detail = future.result()
+                except Exception as exc:
+                    output, status, detail = "", ScriptResult.EXCEPTION, exc
+                self.stdout.write(output)
+                result.add(lineno, status, detail)
+                if result.stop(status, stop_on_error):
+                    for lineno, future in pending:
+                        future.cancel()
+                    for lineno, future in pending:
+                        if not future.cancelled():
+                            future.exception()
+                    return True
+            return False
+
+        for lineno, line in enumerate(lines, 1):
+            stages = self._pipeline_stages(line)
+            if stages is not None:
+                if collect(0):
+                    return
+                status, detail = self._run_script_pipeline(line, stages)
+                result.add(lineno, status, detail)
+                if result.stop(status, stop_on_error):
+                    return
+                state = None
+                continue
+            self.stdout.capture()
+            try:
+                status, detail, call = self._prepare_line(line)
+            finally:
+                output = self.stdout.release()
+            if call is None:
+                pending.append(
+                    (lineno, _Completed((output, status, detail))))
+            else:
+                cmd, func, inner_func, args, kwargs = call
+                if not (getattr(func, PARALLEL_SAFE, None) or
+                        getattr(inner_func, PARALLEL_SAFE, None)):
+                    if collect(0):
+                        return
+                    self.stdout.write(output)
+                    try:
+                        stop = self._bare_result(
+                            self._call(cmd, func, args, kwargs))
+                    except CastError as exc:
+                        self.cast_error(*exc.args)
+                        status, detail = ScriptResult.CAST_ERROR, exc.args[-1]
+                    except CommandCancelled as exc:
+                        self.cancel_error(*exc.args)
+                        status, detail = ScriptResult.CANCELLED, exc
+                    except Exception as exc:
+                        status, detail = ScriptResult.EXCEPTION, exc
+                    else:
+                        if stop:
+                            status = ScriptResult.STOP
+                    result.add(lineno, status, detail)
+                    if result.stop(status, stop_on_error):
+                        return
+                    state = None
+                    continue
+                if in_process:
+                    if state is None:
+                        state = self._process_state()
+                    self.stdout.capture()
+                    try:
+                        args = _materialize(args)
+                        kwargs = dict(zip(kwargs,
+                                          _materialize(kwargs.values())))
+                    except CastError as exc:
+                        self.cast_error(*exc.args)
+                        future = _Completed((
+                            output + self.stdout.release(),
+                            ScriptResult.CAST_ERROR, exc.args[-1]))
+                    else:
+                        self.stdout.release()
+                        future = executor.submit(
+                            _call_in_process, type(self), state, cmd, args,
+                            kwargs)
+                else:
+                    future = executor.submit(
+                        _call_captured, self, self.stdout, cmd, func, args,
+                        kwargs)
+                pending.append((lineno, future))
+            if collect(window):
+                return
+        collect(0)
+
+    def _process_state(self):
+        """Return the picklable part of the instance dict, to be sent to
+        worker processes."""
+        return dict((key, value) for key, value in self.__dict__.items()
+                    if key not in ["stdin", "stdout", "_event_loop",
+                                   "recorder", "cancel_token"])
+
+    def validate_script(self, source, executor=None, chunk_size=10000,
+                        max_pending=None):
+        """Check that each line of a script binds and casts, without running
+        any command, and return a `ScriptResult'.
+
+        source is as for `run_script'.  Each line is parsed, split, bound and
+        cast as by `onecmd' (lazily cast `many' arguments are consumed), but
+        neither the `do_*' method nor `default', `bind_error' or `cast_error'
+        are called, and nothing is written to `self.stdout'.  The statuses are
+        OK, SKIPPED (empty lines), UNKNOWN, BIND_ERROR or CAST_ERROR, and the
+        errors list the line numbers and details of all invalid lines.
+
+        If executor (a `concurrent.futures.Executor', typically a process
+        pool) is given, the script is validated in chunks of chunk_size
+        lines, submitted to it, at most max_pending (as for `run_script')
+        ahead of their results being collected; with a process pool, each
+        chunk is validated on a copy of the interpreter, which must thus be
+        picklable.
+        """
+        if isinstance(source, basestring):
+            with open(source) as file:
+                return self._validate_script(
+                    file, executor, chunk_size, max_pending)
+        else:
+            return self._validate_script(
+                source, executor, chunk_size, max_pending)
+
+    def _validate_script(self, lines, executor, chunk_size, max_pending):
+        if executor is None:
+            return self._validate_lines(1, lines)
+        from concurrent.futures import ProcessPoolExecutor
+        if isinstance(executor, ProcessPoolExecutor):
+            func = functools.partial(_validate_in_process, type(self),
+                                     self._process_state())
+        else:
+            func = self._validate_lines
+        window = max_pending or _default_max_pending()
+        result = ScriptResult()
+        pending = collections.deque()
+        lines = iter(lines)
+        start = 1
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if not chunk:
+                break
+            pending.append(executor.submit(func, start, chunk))
+            start += len(chunk)
+            while len(pending) > window:
+                result.extend(pending.popleft().result())
+        while pending:
+            result.extend(pending.popleft().result())
+        return result
+
+    def _validate_lines(self, start, lines):
+        """Validate lines numbered from start, returning a `ScriptResult'."""
+        result = ScriptResult()
+        for lineno, line in enumerate(lines, start):
+            status, detail = self._validate_line(line)
+            result.add(lineno, status, detail)
+        return result
+
+    def _validate_line(self, line):
+        """Bind and cast a script line, returning a (status, detail) pair.
+
+        Each stage of a pipeline is validated; the stages after the first
+        must only be able to receive piped items."""
+        stages = self._pipeline_stages(line)
+        if stages is None:
+            cmd, arg, line = self.parseline(line)
+            if not line:
+                return ScriptResult.SKIPPED, None
+            return self._validate_stage(cmd, arg, line, False)
+        for i, stage in enumerate(stages):
+            status, detail = self._validate_stage(
+                *self.parseline(stage), piped=i > 0)
+            if status != ScriptResult.OK:
+                return status, detail
+        return ScriptResult.OK, None
+
+    def _validate_stage(self, cmd, arg, line, piped):
+        """Bind and cast a command (a pipeline stage receiving items, if piped
+        is true), returning a (status, detail) pair."""
+        func = None
+        if cmd is not None:
+            func, inner_func = self._find_command(cmd)
+        if func is None:
+            return ScriptResult.UNKNOWN, line
+        try:
+            if piped:
+                args, kwargs = self._construct_piped_arglist(
+                    arg, func, inner_func, ())
+            else:
+                args, kwargs = self.construct_arglist(arg, func, inner_func)
+            for value in itertools.chain(args, kwargs.values()):
+                if _is_iterator(value):
+                    for _ in value:
+                        pass
+        except ArgListError as exc:
+            callback, args = exc.args
+            if callback.__name__ == "cast_error":
+                return ScriptResult.CAST_ERROR, args[-1]
+            return ScriptResult.BIND_ERROR, args[-1]
+        except CastError as exc:
+            return ScriptResult.CAST_ERROR, exc.args[-1]
+        return ScriptResult.OK, None
 
     def split(self, line):
-        """Split the argument list."""
-        return [arg.replace("\0", "") for arg in shlex.split(line)]
+        """Split the argument list, using the `tokenizer' attribute."""
+        presplit = self._presplit
+        if presplit is not None and presplit[0] == line:
+            self._presplit = None
+            return list(presplit[1])
+        return self.tokenizer(line)
 
     def construct_arglist(self, arg, func, inner_func):
         """Construct *args and **kwargs to be passed to func from arg and
         inner_func's signature.
         """
+        if not self.compile_bindings:
+            return self.construct_arglist_uncompiled(arg, func, inner_func)
+        binding = self.get_binding(func, inner_func)
+        if binding.gets_raw:
+            return [arg], {}
+        callargs = self._bind_args(binding, self.split(arg))
+        self._cast_args(binding, callargs)
+        return self._assemble_args(binding, func, callargs)
+
+    def construct_arglist_from_argv(self, argv, func, inner_func):
+        """Construct *args and **kwargs to be passed to func from an already
+        split argument list, as `construct_arglist' does after splitting.
+        """
+        binding = self.get_binding(func, inner_func)
+        if binding.gets_raw:
+            return [" ".join(argv)], {}
+        callargs = self._bind_args(binding, argv)
+        self._cast_args(binding, callargs)
+        return self._assemble_args(binding, func, callargs)
+
+    def _bind_args(self, binding, args):
+        """Bind split arguments according to a compiled binding."""
+        try:
+            args, kw_only = binding.parse_options(args)
+        except ArgListError as exc:
+            raise ArgListError(self.bind_error, exc.args[1])
+        rest = None
+        if self.argfile_prefix is not None:
+            args, rest = self._expand_argfiles(args, binding)
+        try:
+            return binding.bind(self, args, kw_only, rest)
+        except TypeError as exc:
+            exc_s = str(exc)
+            if not binding.implicit_self:
+                args = [self] + args
+            raise ArgListError(self.bind_error, (args, exc_s))
+
+    def _expand_argfiles(self, args, binding=None):
+        """Replace the arguments starting with `argfile_prefix' by the tokens
+        of the named files.
+
+        Return the expanded arguments and, if the binding ends with a lazy
+        `many' parameter, an iterator over the arguments to be streamed to it
+        (or None); these are read only as the parameter is iterated over.
+        """
+        prefix = self.argfile_prefix
+        if not any(arg.startswith(prefix) and arg != prefix for arg in args):
+            return args, None
+        lazy = (binding is not None and binding.rest is not None and
+                binding.caster_of[binding.rest].lazy)
+        parts = []
+        for arg in args:
+            if arg.startswith(prefix) and arg != prefix:
+                try:
+                    tokens = _open_argfile(arg[len(prefix):])
+                except EnvironmentError as exc:
+                    raise ArgListError(self.bind_error, ([arg], str(exc)))
+                if lazy:
+                    tokens = _checked_tokens(
+                        tokens, arg, binding.rest,
+                        binding.caster_of[binding.rest].cast)
+                parts.append(tokens)
+            else:
+                parts.append([arg])
+        tokens = itertools.chain.from_iterable(parts)
+        try:
+            if lazy:
+                fixed = list(itertools.islice(tokens, len(binding.args) - 2))
+                return fixed, tokens
+            return list(tokens), None
+        except UnicodeDecodeError as exc:
+            raise ArgListError(self.bind_error, (
+                args, "Cannot decode argument file: {0}".format(exc)))
+        except CastError as exc:
+            raise ArgListError(self.bind_error, (args, exc.args[-1]))
+
+    def _cast_args(self, binding, callargs):
+        """Cast bound arguments according to a compiled binding."""
+        try:
+            binding.cast(callargs)
+        except ArgListError as exc:
+            raise ArgListError(self.cast_error, exc.args[1])
+
+    def _assemble_args(self, binding, func, callargs):
+        """Reconstruct the argument list to be passed to func."""
+        args, kwargs = binding.assemble(callargs)
+        if inspect.ismethod(func):
+            return args[1:], kwargs
+        else:
+            return args, kwargs
+
+    def _timed_arglist(self, cmd, arg, func, inner_func):
+        """Construct the argument list as `construct_arglist', recording the
+        time spent in each phase and the errors in `stats'.
+
+        Return args, kwargs, and the list of the split, bind and cast times.
+        If `construct_arglist' is overridden, or bindings are not compiled,
+        the whole construction is counted as binding.
+        """
+        stats = self.stats
+        start = timer()
+        timings = []
+        try:
+            if (not self.compile_bindings or
+                type(self).construct_arglist is not
+                ParsedCmd.construct_arglist):
+                timings.append(0.)
+                args, kwargs = self.construct_arglist(arg, func, inner_func)
+                timings.extend([timer() - start, 0.])
+                return args, kwargs, timings
+            binding = self.get_binding(func, inner_func)
+            if binding.gets_raw:
+                timings.extend([0., 0., 0.])
+                return [arg], {}, timings
+            args = self.split(arg)
+            split_end = timer()
+            timings.append(split_end - start)
+            callargs = self._bind_args(binding, args)
+            bind_end = timer()
+            timings.append(bind_end - split_end)
+            self._cast_args(binding, callargs)
+            args, kwargs = self._assemble_args(binding, func, callargs)
+            timings.append(timer() - bind_end)
+            return args, kwargs, timings
+        except ArgListError as exc:
+            timings.append(timer() - start - sum(timings))
+            callback = exc.args[0]
+            stats.record(cmd, timings,
+                         "cast_error" if callback.__name__ == "cast_error"
+                         else "bind_error")
+            raise
+
+    def _onecmd_timed(self, cmd, arg, func, inner_func):
+        """Second half of onecmd, recording statistics in `stats'."""
+        try:
+            args, kwargs, timings = self._timed_arglist(
+                cmd, arg, func, inner_func)
+        except ArgListError as exc:
+            callback, args = exc.args
+            return callback(*args)
+        start = timer()
+        try:
+            result = self._bare_result(self._call(cmd, func, args, kwargs))
+        except CastError as exc:
+            timings.append(timer() - start)
+            self.stats.record(cmd, timings, "cast_error")
+            return self.cast_error(*exc.args)
+        except CommandCancelled as exc:
+            timings.append(timer() - start)
+            self.stats.record(cmd, timings, "exception")
+            return self.cancel_error(*exc.args)
+        except BaseException:
+            timings.append(timer() - start)
+            self.stats.record(cmd, timings, "exception")
+            raise
+        timings.append(timer() - start)
+        self.stats.record(cmd, timings)
+        return result
+
+    def construct_arglist_uncompiled(self, arg, func, inner_func):
+        """Construct *args and **kwargs by introspecting inner_func.
+
+        This is the reference implementation of `construct_arglist', used
+        when `compile_bindings' is false.
+        """
         if getattr(inner_func, GETS_RAW, None):
             return [arg], {}
         args = self.split(arg)
@@ -278,6 +2629,8 @@ class ParsedCmd(Cmd, object):
                 args = args[2:]
             else:
                 break
+        if self.argfile_prefix is not None:
+            args = self._expand_argfiles(args)[0]
         if not inspect.ismethod(inner_func):
             args.insert(0, self)
         try:
@@ -286,7 +2639,7 @@ class ParsedCmd(Cmd, object):
             exc_s = str(exc)
             raise ArgListError(self.bind_error, (args, exc_s))
         for varname in callargs:
-            cast = argspec.annotations.get(varname)
+            cast = get_caster(argspec.annotations.get(varname))
             if not callable(cast):
                 continue
             bound_val = callargs[varname]
@@ -297,8 +2650,9 @@ class ParsedCmd(Cmd, object):
                         bound_val[i] = cast(arg)
                     except Exception as exc:
                         exc_s = str(exc)
-                        raise ArgListError(self.cast_error,
-                                           (varname, arg, cast, exc_s))
+                        raise ArgListError(
+                            self.cast_error,
+                            ("{0}[{1}]".format(varname, i), arg, cast, exc_s))
                 callargs[varname] = bound_val
             elif varname == argspec.varkw:
                 for key, val in bound_val.items():
@@ -344,44 +2698,319 @@ class ParsedCmd(Cmd, object):
 
     def cast_error(self, varname, value, cast, exc):
         """Called when an argument cannot be cast by the given caster."""
+        import textwrap
         self.stdout.write(
             textwrap.fill('*** While trying to cast "{0}" with "{1}" for '
                           'argument "{2}", the following exception was '
                           'thrown:\n'.format(value, cast, varname),
-                          72, subsequent_indent="*** "))
-        self.stdout.write("*** {}".format(exc))
+                          72, subsequent_indent="*** ") +
+            "*** {}".format(exc))
+
+    def cancel_error(self, cmd, timeout):
+        """Called when a command is cancelled, after timeout seconds if its
+        deadline passed, or explicitly if timeout is None."""
+        if timeout is None:
+            self.stdout.write('*** Command "{0}" was cancelled.\n'.format(cmd))
+        else:
+            self.stdout.write('*** Command "{0}" timed out after {1} s.\n'.
+                              format(cmd, timeout))
 
     def do_help(self, cmd=None):
+        if not cmd:
+            self.stdout.write(self._class_cached(
+                "_help_index", self._render_help,
+                [self.doc_leader, self.doc_header, self.misc_header,
+                 self.undoc_header, self.ruler]))
+            return
+        lazy = self._lazy_command("do_" + cmd)
+        if (lazy is not None and lazy.doc and
+            not hasattr(self, "help_" + cmd)):
+            # do not import the command just to show its docstring
+            self.stdout.write("%s\n" % str(lazy.doc))
+            if self.show_usage and lazy.signature is not None:
+                usage = lazy.signature.get("usage")
+                if usage is not None:
+                    self.stdout.write(usage + "\n")
+            return
         Cmd.do_help(self, cmd)
-        if not cmd or not self.show_usage:
+        if not self.show_usage:
             return
         do_ = getattr(self, "do_" + cmd, None)
-        if not do_ or hasattr(self, "help_ " + cmd):
-            return
-        while (hasattr(do_, "__wrapped__") and
-               not getattr(do_, USE_MY_ANNOTATIONS, None)):
-            do_ = do_.__wrapped__
-        if getattr(do_, GETS_RAW, None):
+        if not do_ or hasattr(self, "help_" + cmd):
             return
-        spec = getfullargspec(do_)
-        args, varargs, varkw, defaults, kwonlyargs, kwonlydefaults, ann = spec
-        non_kw_args = args[:-len(defaults)] if defaults else args
-        kw_args = args[-len(defaults):] if defaults else []
-        if not defaults:
-            defaults = []
-        if not kwonlydefaults:
-            kwonlydefaults = {}
-        helpstr = "\t" + cmd
-        for arg, default in kwonlydefaults.items():
-            helpstr += " [-{0} {1}(={2})]".format(arg, arg[0].upper(), default)
-        for arg, default in zip(kw_args, defaults):
-            helpstr += " [{0}(={1})]".format(arg.upper(), default)
-        for arg in non_kw_args[1:]:
-            helpstr += " {0}".format(arg.upper())
-        if varargs:
-            helpstr += " [{0}]".format(varargs.upper())
-        self.stdout.write(helpstr + "\n")
+        usage = self.get_binding(do_).usage(cmd)
+        if usage is not None:
+            self.stdout.write(usage + "\n")
+
+    def _render_help(self):
+        """Return the output of `help' without arguments.
+
+        This follows cmd.Cmd.do_help, but does not import lazy commands whose
+        docstring is known."""
+        names = self.get_names()
+        cmds_doc = []
+        cmds_undoc = []
+        topics = set(name[5:] for name in names if name[:5] == "help_")
+        for name in sorted(set(names)):
+            if name[:3] == "do_":
+                cmd = name[3:]
+                lazy = self._lazy_command(name)
+                if cmd in topics:
+                    cmds_doc.append(cmd)
+                    topics.remove(cmd)
+                elif (lazy.doc if lazy is not None and lazy.doc is not None
+                      else getattr(self, name).__doc__):
+                    cmds_doc.append(cmd)
+                else:
+                    cmds_undoc.append(cmd)
+        stdout = self.stdout
+        self.stdout = output = _ThreadOutput(None)
+        output.capture()
+        try:
+            self.stdout.write("%s\n" % str(self.doc_leader))
+            self.print_topics(self.doc_header, cmds_doc, 15, 80)
+            self.print_topics(self.misc_header, sorted(topics), 15, 80)
+            self.print_topics(self.undoc_header, cmds_undoc, 15, 80)
+        finally:
+            self.stdout = stdout
+        return output.release()
+
+    @classmethod
+    def command_signatures(cls):
+        """Describe the signatures of all commands, without instantiating
+        the class.
+
+        Return a dict mapping command names to dicts with keys "doc",
+        "gets_raw", "usage" and "parameters" (None for `@gets_raw' methods),
+        a list of dicts with keys "name", "kind" ("positional", "optional",
+        "option", "varargs" or "varkw"), and, if applicable, "default" and
+        "caster" (whose name is given).  Defaults that cannot be represented
+        in JSON are replaced by their repr.
+        """
+        signatures = {}
+        for name in sorted(set(dir(cls))):
+            if name.startswith("do_"):
+                lazy = cls._lazy_command(name)
+                if lazy is not None and lazy.signature is not None:
+                    signatures[name[3:]] = lazy.signature
+                else:
+                    binding = cls.get_binding(getattr(cls, name))
+                    signatures[name[3:]] = binding.describe(name[3:])
+        return signatures
+
+    @classmethod
+    def export_signatures(cls, file):
+        """Write the output of `command_signatures' to file, as JSON."""
+        import json
+        json.dump(cls.command_signatures(), file, indent=2, sort_keys=True)
+
+_FALSE_STRINGS = frozenset(["off", "false", "f", "0"])
 
 def boolean(s):
     """A generalized boolean caster."""
-    return s.lower() not in ["off", "false", "f", "0"]
+    return s.lower() not in _FALSE_STRINGS
+boolean.completions = ["false", "off", "on", "true"]
+
+def _boolean_bulk(values):
+    """Cast a sequence of strings with `boolean'."""
+    return [value.lower() not in _FALSE_STRINGS for value in values]
+boolean.bulk = _boolean_bulk
+
+class many(object):
+    """Annotation of the last positional parameter of a `do_*' method (which
+    must not take *args), which then receives all the remaining arguments,
+    cast by cast (if given).
+
+    By default, the parameter receives a list.  If lazy is true, it receives
+    an iterator that casts each argument when it is reached; a failure then
+    raises `CastError' from the iterator, which `onecmd' reports through
+    `cast_error'.  If dtype is given, it receives a NumPy array of that dtype
+    (NumPy is imported when needed, and converts the arguments itself if cast
+    is not given).
+    """
+
+    def __init__(self, cast=None, lazy=False, dtype=None):
+        if lazy and dtype is not None:
+            raise ValueError("lazy and dtype are mutually exclusive")
+        self.cast = cast
+        self.lazy = lazy
+        self.dtype = dtype
+        self.completions = getattr(cast, "completions", None)
+
+    def __repr__(self):
+        args = [getattr(self.cast, "__name__", repr(self.cast))]
+        if self.lazy:
+            args.append("lazy=True")
+        if self.dtype is not None:
+            args.append("dtype={0}".format(
+                getattr(self.dtype, "__name__", repr(self.dtype))))
+        return "many({0})".format(", ".join(args))
+
+    def __call__(self, value):
+        # many annotations are handled by the binding
+        raise TypeError("{0!r} cannot cast a single value".format(self))
+
+    def cast_all(self, values, varname):
+        """Cast the remaining arguments.
+
+        Raise ArgListError(None, cast_error_args) on failure."""
+        if self.lazy:
+            return self._iterate(values, varname)
+        if self.dtype is None:
+            if self.cast is None:
+                return list(values)
+            return _cast_all(self.cast, values, varname)
+        import numpy
+        if self.cast is not None:
+            return numpy.array(_cast_all(self.cast, values, varname),
+                               dtype=self.dtype)
+        try:
+            return numpy.array(values, dtype=str).astype(self.dtype)
+        except (TypeError, ValueError):
+            # let the scalar type report the failing element
+            return numpy.array(
+                _cast_all(numpy.dtype(self.dtype).type, values, varname),
+                dtype=self.dtype)
+
+    def extend(self, values, items):
+        """Append items, which are not cast, to the result of `cast_all'."""
+        if self.lazy:
+            return itertools.chain(values, items)
+        if self.dtype is None:
+            return values + list(items)
+        import numpy
+        return numpy.concatenate(
+            [values, numpy.array(list(items), dtype=self.dtype)])
+
+    def _iterate(self, values, varname):
+        if self.cast is None:
+            for value in values:
+                yield value
+            return
+        for i, value in enumerate(values):
+            try:
+                cast_value = self.cast(value)
+            except Exception as exc:
+                raise CastError(
+                    "{0}[{1}]".format(varname, i), value, self.cast, str(exc))
+            yield cast_value
+
+class Caster(object):
+    """A caster with metadata, and optionally memoized.
+
+    If pure is true, func must always return the same (immutable) value for
+    the same string, and its results are memoized (the memo is emptied when
+    it reaches maxsize entries).  completions is used by completion, as the
+    `completions' attribute of any caster; metavar, if given, replaces the
+    placeholder of keyword-only options in usage lines.
+    """
+
+    def __init__(self, func, pure=False, maxsize=1024, completions=None,
+                 metavar=None, name=None):
+        self.func = func
+        self.pure = pure
+        self.maxsize = maxsize
+        self.completions = (completions if completions is not None
+                            else getattr(func, "completions", None))
+        self.metavar = metavar
+        self.__name__ = name or getattr(func, "__name__", repr(func))
+        self._memo = {} if pure else None
+        if not pure and hasattr(func, "bulk"):
+            self.bulk = func.bulk
+
+    def __repr__(self):
+        return "<Caster {0}>".format(self.__name__)
+
+    def __call__(self, value):
+        memo = self._memo
+        if memo is None:
+            return self.func(value)
+        try:
+            return memo[value]
+        except KeyError:
+            pass
+        except TypeError: # unhashable
+            return self.func(value)
+        result = self.func(value)
+        if len(memo) >= self.maxsize:
+            memo.clear()
+        memo[value] = result
+        return result
+
+def caster(pure=False, maxsize=1024, completions=None, metavar=None,
+           name=None):
+    """Decorator factory wrapping a function in a `Caster'."""
+    def decorator(func):
+        return Caster(func, pure, maxsize, completions, metavar, name)
+    return decorator
+
+_CASTERS = {}
+_CASTER_FACTORIES = {}
+
+def register_caster(annotation, cast=None, factory=None):
+    """Register the caster used for arguments annotated with annotation.
+
+    Either cast is used for annotation itself, or, if annotation is a class,
+    factory is called with each of its subclasses (and annotation) used as an
+    annotation to build their caster.  A class may also be given by its
+    qualified name ("module.Class"), so that its module is not imported until
+    it is used as an annotation.
+    """
+    if (cast is None) == (factory is None):
+        raise ValueError("Exactly one of cast and factory must be given.")
+    if cast is not None:
+        _CASTERS[annotation] = cast
+    else:
+        _CASTER_FACTORIES[annotation] = factory
+
+def get_caster(annotation):
+    """Return the caster used for annotation: the registered one if any,
+    otherwise annotation itself if it is callable, or None."""
+    try:
+        cast = _CASTERS.get(annotation)
+    except TypeError: # unhashable
+        return annotation if callable(annotation) else None
+    if cast is not None:
+        return cast
+    if isinstance(annotation, type):
+        for base in annotation.__mro__:
+            factory = (_CASTER_FACTORIES.get(base) or _CASTER_FACTORIES.get(
+                "{0}.{1}".format(base.__module__, base.__name__)))
+            if factory is not None:
+                cast = _CASTERS[annotation] = factory(annotation)
+                return cast
+    return annotation if callable(annotation) else None
+
+def _enum_caster(enum_class):
+    """Cast by member name (completed), then by value."""
+    members = enum_class.__members__
+    def cast(value):
+        try:
+            return members[value]
+        except KeyError:
+            return enum_class(value)
+    return Caster(cast, completions=sorted(members),
+                  name=enum_class.__name__)
+
+def _isoformat_caster(cls):
+    """Cast ISO 8601 dates and datetimes (memoized if strptime is needed)."""
+    if hasattr(cls, "fromisoformat"): # already fast
+        return Caster(cls.fromisoformat, name=cls.__name__)
+    import datetime
+    fmt = ("%Y-%m-%dT%H:%M:%S" if issubclass(cls, datetime.datetime)
+           else "%Y-%m-%d")
+    def cast(value):
+        parsed = datetime.datetime.strptime(value, fmt)
+        return (parsed if issubclass(cls, datetime.datetime)
+                else cls(parsed.year, parsed.month, parsed.day))
+    return Caster(cast, pure=True, name=cls.__name__)
+
+def _path_caster(cls):
+    """Cast paths, memoized."""
+    return Caster(cls, pure=True, name=cls.__name__)
+
+register_caster("enum.Enum", factory=_enum_caster)
+register_caster("datetime.date", factory=_isoformat_caster)
+for _name in ["pathlib.PurePath", "pathlib._local.PurePath"]:
+    register_caster(_name, factory=_path_caster)
+del _name
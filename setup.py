@@ -5,7 +5,7 @@ setup(
     version='0.1.1',
     author='Antony Lee',
     author_email='anntzer.lee@gmail.com',
-    py_modules=['parsedcmd'],
+    py_modules=['parsedcmd', '_parsedcmd_async'],
     url='http://github.com/anntzer/parsedcmd',
     license='LICENSE.txt',
     description='A cmd with argument list parsing.',
@@ -1,6 +1,14 @@
 from __future__ import print_function
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
 from StringIO import StringIO
 from parsedcmd import *
+from parsedcmd import (
+    ScriptResult, _read_argfile, fast_split, shlex_split)
 
 class UI(ParsedCmd):
     # Non-annotated arguments default to str.
@@ -66,9 +74,522 @@ class Tests:
         assert (self.out.getvalue().strip() ==
                 UI.do_multiply.__doc__ + "\n\tmultiply MUL [NUMS]")
 
+    def test_subclass_binding(self):
+        self.ui.onecmd("multiply 2 3")
+        class SubUI(UI):
+            @annotate(mul=float, nums=float)
+            def do_multiply(self, mul, *nums):
+                UI.do_multiply.__func__(self, mul, *nums)
+        SubUI(stdout=self.out).onecmd("multiply 2 3")
+        assert self.out.getvalue().strip() == "6\n6.0"
+
+    def test_uncompiled_bindings(self):
+        self.ui.compile_bindings = False
+        self.ui.onecmd("print -repeat 2 def")
+        assert self.out.getvalue().strip() == "def\ndef"
+
+    def test_run_script(self):
+        result = self.ui.run_script(
+            ["multiply 2 1", "", "multiply x", "print -repeat 2 def"])
+        output = self.out.getvalue()
+        assert output.startswith("2\n*** While trying to cast \"x\"")
+        assert output.endswith("'x'def\ndef\n")
+        assert list(result.statuses) == [
+            ScriptResult.OK, ScriptResult.SKIPPED, ScriptResult.CAST_ERROR,
+            ScriptResult.OK]
+        assert result.error_lines == [3]
+
+    def test_run_script_stop_on_error(self):
+        result = self.ui.run_script(
+            StringIO("multiply 2 1\nmultiply\nmultiply 3 1\n"),
+            stop_on_error=True)
+        assert self.out.getvalue().startswith("2\n*** ")
+        assert len(result) == 2
+        assert result.errors[0][:2] == (2, ScriptResult.BIND_ERROR)
+
+    def test_validate_script(self):
+        lines = ["multiply 2 1", "", "multiply x", "print -repeat 2 def",
+                 "nope", "print a b"]
+        result = self.ui.validate_script(lines)
+        assert self.out.getvalue() == ""
+        assert list(result.statuses) == [
+            ScriptResult.OK, ScriptResult.SKIPPED, ScriptResult.CAST_ERROR,
+            ScriptResult.OK, ScriptResult.UNKNOWN, ScriptResult.BIND_ERROR]
+        assert result.error_lines == [3, 5, 6]
+        assert result.errors[1] == (5, ScriptResult.UNKNOWN, "nope")
+
+    def test_validate_script_pipeline(self):
+        ui = UI(stdout=self.out, pipe_symbol="|")
+        result = ui.validate_script(
+            ["multiply 2 1 | multiply 3", "multiply 2 | print",
+             "multiply x | multiply 3", "multiply 2 | nope",
+             "shell print(1 | 2)"])
+        assert self.out.getvalue() == ""
+        assert list(result.statuses) == [
+            ScriptResult.OK, ScriptResult.BIND_ERROR, ScriptResult.CAST_ERROR,
+            ScriptResult.UNKNOWN, ScriptResult.OK]
+
+    def test_stats(self):
+        class StatsUI(UI):
+            do_stats = stats_command
+        ui = StatsUI(stdout=self.out, stats=True)
+        for line in ["multiply 2 1", "multiply x", "multiply", "print"]:
+            ui.onecmd(line)
+        stat = ui.stats.commands["multiply"]
+        assert (stat.calls, stat.bind_errors, stat.cast_errors) == (3, 1, 1)
+        assert sum(stat.histogram) == 1
+        self.out.truncate(0)
+        self.out.seek(0)
+        ui.onecmd("stats")
+        lines = self.out.getvalue().splitlines()
+        assert lines[0].split() == ["command", "calls", "bind", "cast", "exc",
+                                    "split", "bind", "cast", "run"]
+        assert lines[1].split()[:5] == ["multiply", "3", "1", "1", "0"]
+        assert lines[2].split()[:5] == ["print", "1", "0", "0", "0"]
+        ui.onecmd("stats reset")
+        assert list(ui.stats.commands) == ["stats"]
+
+    def test_complete(self):
+        assert self.ui.completenames("m") == ["multiply"]
+        assert self.ui.completedefault("-", "print -", 6, 7) == [
+            "-flag", "-repeat"]
+        assert self.ui.completedefault("-", "print -flag on -", 15, 16) == [
+            "-repeat"]
+        assert self.ui.completedefault("o", "print -flag o", 12, 13) == [
+            "off", "on"]
+        assert self.ui.completedefault("", "shell ", 6, 6) == []
+
+    def test_help_cached(self):
+        self.ui.onecmd("help")
+        self.ui.onecmd("help")
+        output = self.out.getvalue()
+        assert output[:len(output) // 2] == output[len(output) // 2:]
+        assert "multiply  print  shell" in output
+        UI.do_zzz = UI.do_multiply
+        try:
+            self.ui.onecmd("help")
+        finally:
+            del UI.do_zzz
+        assert "multiply  print  shell  zzz" in self.out.getvalue()
+
+    def test_command_index_invalidation(self):
+        class SubUI(UI):
+            def do_foo(self):
+                pass
+        ui = SubUI(stdout=self.out)
+        assert ui.completenames("f") == ["foo"]
+        del SubUI.do_foo
+        SubUI.do_bar = lambda self: None
+        assert ui.completenames("f") == []
+        assert ui.completenames("b") == ["bar"]
+        UI.do_baz = lambda self: None
+        try:
+            assert ui.completenames("b") == ["bar", "baz"]
+        finally:
+            del UI.do_baz
+        assert ui.completenames("b") == ["bar"]
+
+    def test_help_cache_invalidation(self):
+        class SubUI(UI):
+            def do_foo(self):
+                pass
+        ui = SubUI(stdout=self.out)
+        ui.onecmd("help")
+        del SubUI.do_foo
+        SubUI.do_bar = lambda self: None
+        ui.onecmd("help")
+        assert self.out.getvalue().endswith(
+            "Undocumented commands:\n======================\nbar  help\n\n")
+        SubUI.do_bar = UI.do_multiply
+        ui.onecmd("help")
+        assert self.out.getvalue().endswith(
+            "bar  multiply  print  shell\n\n"
+            "Undocumented commands:\n======================\nhelp\n\n")
+
+
+    def test_command_signatures(self):
+        signatures = UI.command_signatures()
+        assert signatures["multiply"]["usage"] == "\tmultiply MUL [NUMS]"
+        assert signatures["multiply"]["parameters"] == [
+            {"name": "mul", "kind": "positional", "caster": "int"},
+            {"name": "nums", "kind": "varargs", "caster": "int"}]
+        assert signatures["shell"]["gets_raw"]
+        assert signatures["shell"]["parameters"] is None
+
+    def test_lazy_command(self):
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, "_lazy_plugin.py"), "w") as file:
+            file.write('def greet(self, name, times=1):\n'
+                       '    """Greet someone."""\n'
+                       '    self.stdout.write("hello " + name + "\\n")\n')
+        sys.path.insert(0, directory)
+        try:
+            class LazyUI(UI):
+                pass
+            LazyUI.register_lazy(
+                "greet", "_lazy_plugin:greet",
+                {"doc": "Greet someone.", "gets_raw": False,
+                 "usage": "\tgreet [TIMES(=1)] NAME",
+                 "parameters": [
+                     {"name": "name", "kind": "positional"},
+                     {"name": "times", "kind": "optional", "default": 1}]})
+            out = StringIO()
+            ui = LazyUI(stdout=out)
+            ui.onecmd("help")
+            ui.onecmd("help greet")
+            assert "greet" in out.getvalue()
+            assert "Greet someone." in out.getvalue()
+            signatures = LazyUI.command_signatures()
+            assert signatures["greet"]["doc"] == "Greet someone."
+            assert "_lazy_plugin" not in sys.modules
+            ui.onecmd("greet world")
+            assert "_lazy_plugin" in sys.modules
+            assert out.getvalue().endswith("hello world\n")
+            assert not isinstance(vars(LazyUI)["do_greet"], LazyCommand)
+        finally:
+            sys.path.remove(directory)
+            sys.modules.pop("_lazy_plugin", None)
+            shutil.rmtree(directory)
+
+    def test_main(self):
+        assert self.ui.main(["print", "-repeat", "2", "a 'b' \\c"]) == 0
+        assert self.out.getvalue() == "a 'b' \\c\na 'b' \\c\n"
+        assert self.ui.main(["multiply", "2", "x"]) == 2
+        assert self.ui.main(["print", "a", "b"]) == 2
+        assert self.ui.main(["nonexistent"]) == 2
+        assert self.out.getvalue().endswith(
+            "*** Unknown syntax: nonexistent\n")
+
+    def test_cast_error_index(self):
+        self.ui.onecmd("multiply 2 1 x")
+        assert '"nums[1]"' in self.out.getvalue()
+
+    def test_many(self):
+        class ManyUI(UI):
+            @annotate(mul=int, nums=many(int))
+            def do_sum(self, mul, nums):
+                print(mul * sum(nums), file=self.stdout)
+
+            @annotate(nums=many(int, lazy=True))
+            def do_lazy(self, nums):
+                for num in nums:
+                    print(num, file=self.stdout)
+        ui = ManyUI(stdout=self.out)
+        ui.onecmd("sum 2 1 2 3")
+        ui.onecmd("sum 2")
+        assert self.out.getvalue() == "12\n0\n"
+        ui.onecmd("lazy 1 x 3")
+        assert self.out.getvalue().startswith("12\n0\n1\n*** While")
+        assert '"nums[1]"' in self.out.getvalue()
+
+    def test_argfile(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "nums.txt")
+        with open(path, "w") as file:
+            file.write("1 2\n  3\n")
+        try:
+            self.ui.argfile_prefix = "@"
+            self.ui.onecmd("multiply -2 @" + path)
+            self.ui.onecmd("print -repeat 1 @" + path)
+            assert self.out.getvalue().startswith(
+                "-2\n-4\n-6\n*** This argument list could not be bound")
+            self.ui.onecmd("multiply 2 @" + path + ".missing")
+            assert "No such file" in self.out.getvalue()
+            self.ui.onecmd("!print('@x', file=self.stdout)")
+            assert self.out.getvalue().endswith("@x\n")
+            with open(path, "rb") as file:
+                assert list(_read_argfile(file, 3)) == ["1", "2", "3"]
+            class LazyUI(UI):
+                @annotate(mul=int, nums=many(int, lazy=True))
+                def do_sum(self, mul, nums):
+                    print(mul * sum(nums), file=self.stdout)
+            LazyUI(stdout=self.out, argfile_prefix="@").onecmd(
+                "sum 2 @" + path + " 4")
+            assert self.out.getvalue().endswith("@x\n20\n")
+        finally:
+            shutil.rmtree(directory)
+
+    def test_pipeline(self):
+        class PipeUI(UI):
+            @annotate(n=int)
+            def do_range(self, n):
+                for i in range(n):
+                    yield i
+
+            def do_square(self, *nums):
+                return [num ** 2 for num in nums]
+
+            @annotate(nums=many(lazy=True))
+            def do_total(self, nums):
+                print(sum(nums), file=self.stdout)
+        ui = PipeUI(stdout=self.out, pipe_symbol="|")
+        ui.onecmd("range 3 | multiply 2")
+        ui.onecmd("range 3 | square | total")
+        ui.onecmd("range 3 | square")
+        ui.onecmd("print a|b")
+        ui.onecmd("print '|'")
+        assert self.out.getvalue() == "0\n2\n4\n5\n0\n1\n4\na|b\n|\n"
+        ui.onecmd("range 3 | print")
+        assert self.out.getvalue().endswith(
+            "*** This command does not take piped input.\n")
+
+    def test_pipeline_raw_and_bare(self):
+        class PipeUI(UI):
+            def do_range(self, n):
+                return iter(range(int(n)))
+        ui = PipeUI(stdout=self.out, pipe_symbol="|")
+        ui.onecmd("shell print(1 | 2, file=self.stdout)")
+        assert ui.onecmd("range 2") is None
+        assert self.out.getvalue() == "3\n0\n1\n"
+        result = ui.run_script(["range 3 | multiply 2", "range 2 | print"])
+        assert list(result.statuses) == [
+            ScriptResult.OK, ScriptResult.BIND_ERROR]
+        assert self.out.getvalue().startswith("3\n0\n1\n0\n2\n4\n*** ")
+        # Without pipelines, results are returned as by Cmd.onecmd.
+        out = StringIO()
+        ui = PipeUI(stdout=out)
+        assert ui.onecmd("range 2") is not None
+        assert ui.run_script(["range 2"]).statuses[0] == ScriptResult.STOP
+        assert ui.main(["range", "2"]) == 0
+        assert out.getvalue() == ""
+
+    def test_cached(self):
+        class CachedUI(UI):
+            calls = 0
+
+            @cached(maxsize=2)
+            @annotate(key=int)
+            def do_lookup(self, key):
+                CachedUI.calls += 1
+                print(key * 2, file=self.stdout)
+
+            @cached(ttl=0)
+            def do_expiring(self):
+                CachedUI.calls += 1
+
+            @invalidates("lookup")
+            def do_update(self):
+                pass
+        ui = CachedUI(stdout=self.out)
+        for line in ["lookup 1", "lookup 01", "lookup 2", "lookup 3",
+                     "lookup 1", "update", "lookup 3"]:
+            ui.onecmd(line)
+        assert self.out.getvalue() == "2\n2\n4\n6\n2\n6\n"
+        assert CachedUI.calls == 5
+        ui.onecmd("expiring")
+        ui.onecmd("expiring")
+        assert CachedUI.calls == 7
+        info = CachedUI.command_cache_info()
+        assert info["lookup"] == (1, 5, 2, 1, 2)
+        assert info["expiring"] == (0, 2, 1, 1, 128)
+        other = CachedUI(stdout=StringIO())
+        other.onecmd("lookup 3")
+        assert CachedUI.calls == 8
+        assert other.stdout.getvalue() == "6\n"
+
+    def test_casters(self):
+        calls = []
+        @caster(pure=True, completions=["1", "2"], metavar="N")
+        def counted(value):
+            calls.append(value)
+            return int(value)
+        class CasterUI(UI):
+            @annotate(times=counted)
+            @kw_only("times")
+            def do_repeat(self, word="a", times=1):
+                print(word * times, file=self.stdout)
+        ui = CasterUI(stdout=self.out, show_usage=True)
+        ui.onecmd("repeat")
+        ui.onecmd("repeat -times 2 b")
+        ui.onecmd("repeat -times 2 c")
+        assert self.out.getvalue() == "a\nbb\ncc\n"
+        assert calls == ["2"]
+        assert ui.completedefault("", "repeat -times ", 14, 14) == ["1", "2"]
+        ui.onecmd("help repeat")
+        assert "[-times N(=1)]" in self.out.getvalue()
+
+    def test_record_replay(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "session.log")
+        try:
+            with CommandRecorder(path) as recorder:
+                ui = UI(stdout=self.out, recorder=recorder)
+                for line in ["print -repeat 2 'a b'", "multiply 2 x",
+                             "nonexistent", "!print(1, file=self.stdout)"]:
+                    ui.onecmd(line)
+            entries = list(CommandRecorder.read(path))
+            assert entries[0].strings == [
+                "print -repeat 2 'a b'", "print", "-repeat", "2", "a b"]
+            assert [entry.status for entry in entries] == [
+                ScriptResult.OK, ScriptResult.CAST_ERROR,
+                ScriptResult.UNKNOWN, ScriptResult.OK]
+            out = StringIO()
+            result = UI(stdout=out).replay(path)
+            assert result.ok and len(result) == 4 and not out.getvalue()
+            class ChangedUI(UI):
+                @staticmethod
+                def tokenizer(line):
+                    raise AssertionError("replayed arguments are not split")
+
+                @annotate(flag=boolean, repeat=int)
+                @kw_only("flag", "repeat")
+                def do_print(self, line="abc", flag=True, repeat=1):
+                    print(line.upper(), file=self.stdout)
+            result = ChangedUI().replay(path)
+            assert [divergence[:2] for divergence in result.divergences] == [
+                (0, "print -repeat 2 'a b'")]
+        finally:
+            shutil.rmtree(directory)
+
+    def test_record_with_stats(self):
+        class SplitUI(UI):
+            def construct_arglist(self, arg, func, inner_func):
+                self.constructed += 1
+                return UI.construct_arglist(self, arg, func, inner_func)
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "session.log")
+        try:
+            with CommandRecorder(path) as recorder:
+                ui = SplitUI(stdout=self.out, recorder=recorder, stats=True)
+                ui.constructed = 0
+                ui.onecmd("multiply 2 1")
+                ui.compile_bindings = False
+                ui.onecmd("print -repeat 2 a")
+            assert ui.stats.commands["multiply"].calls == 1
+            assert ui.stats.commands["print"].calls == 1
+            assert ui.constructed == 2
+            assert self.out.getvalue() == "2\na\na\n"
+            ui = SplitUI(stdout=self.out, stats=True)
+            ui.constructed = 0
+            assert ui.replay(path).ok
+            assert ui.stats.commands["multiply"].calls == 1
+            assert ui.constructed == 2
+        finally:
+            shutil.rmtree(directory)
+
+    def test_buffered_output(self):
+        class Stream(object):
+            def __init__(self):
+                self.writes = []
+                self.flushes = 0
+
+            def write(self, data):
+                self.writes.append(data)
+
+            def flush(self):
+                self.flushes += 1
+        stream = Stream()
+        ui = UI(stdout=stream, buffer_output="command")
+        ui.onecmd("print -repeat 3 def")
+        assert stream.writes == ["def\ndef\ndef\n"] and stream.flushes == 1
+        ui.stdout.write("x")
+        assert stream.writes[-1] == "x"
+        stream = Stream()
+        ui = UI(stdout=BufferedOutput(stream, "size", size=10))
+        ui.onecmd("print -repeat 2 abc")
+        assert stream.writes == []
+        ui.onecmd("print -repeat 2 abc")
+        assert stream.writes == ["abc\nabc\nabc"]
+        ui.stdout.flush()
+        assert stream.writes == ["abc\nabc\nabc", "\nabc\n"]
+        stream = Stream()
+        ui = UI(stdout=stream, buffer_output="immediate")
+        ui.onecmd("print -repeat 2 abc")
+        assert stream.writes == ["abc", "\n", "abc", "\n"]
+
+    def test_buffered_output_cmdloop(self):
+        class LoopUI(UI):
+            def do_quit(self):
+                return True
+        ui = LoopUI(stdin=StringIO("print -repeat 2 a\nquit\n"),
+                    stdout=BufferedOutput(self.out, "size"))
+        ui.use_rawinput = False
+        ui.cmdloop("intro")
+        assert self.out.getvalue() == "intro\n(Cmd) a\na\n(Cmd) "
+
+    def test_timeout(self):
+        class SlowUI(UI):
+            @timeout(0.05)
+            def do_spin(self):
+                while True:
+                    self.cancel_token.check()
+                    time.sleep(0.001)
+
+            @annotate(delay=float)
+            def do_wait(self, delay):
+                time.sleep(delay)
+                self.cancel_token.check()
+                print("done", file=self.stdout)
+
+            @timeout(None)
+            def do_free(self):
+                self.cancel_token.check()
+                print("free", file=self.stdout)
+
+            def do_stop(self):
+                self.cancel_token.cancel()
+                self.cancel_token.check()
+
+            @annotate(delay=float)
+            def do_nap(self, delay):
+                time.sleep(delay)
+                print("woke", file=self.stdout)
+        ui = SlowUI(stdout=self.out, command_timeout=0.02)
+        ui.onecmd("spin")
+        assert self.out.getvalue() == (
+            '*** Command "spin" timed out after 0.05 s.\n')
+        ui.onecmd("wait 0")
+        ui.onecmd("free")
+        ui.onecmd("stop")
+        assert self.out.getvalue().endswith(
+            'done\nfree\n*** Command "stop" was cancelled.\n')
+        ui.onecmd("nap 0.03")
+        assert self.out.getvalue().endswith(
+            'woke\n*** Command "nap" timed out after 0.02 s.\n')
+        result = ui.run_script(["wait 0.03", "wait 0"])
+        assert result.errors[0][:2] == (1, ScriptResult.CANCELLED)
+        assert ui.main(["wait", "0.03"]) == 1
+        assert not ui.cancel_token.cancelled
+
     def test_shell(self):
         self.ui.onecmd("!print(1, file=self.stdout)")
         assert self.out.getvalue().strip() == "1"
 
+SPLIT_CORPUS = [
+    "", "  ", "print", "print -repeat 3 def", " a\tb\r\nc ", "a\0b",
+    "'a b' \"c d\"", "a'b'c\"d\"e", "''", "a '' b", '""', "'\\'",
+    '"\\""', '"\\\\"', '"\\a"', "a\\ b", "a\\", "'a", '"a', '"a\\',
+    '"a\\"', "a\\\nb", "#a b#", "\u00e9 \u00e0", "a\x0bb", "\\\0",
+]
+
+def _split_or_error(split, line):
+    try:
+        return split(line)
+    except ValueError as exc:
+        return str(exc)
+
+class TestSplit:
+    def test_corpus(self):
+        for line in SPLIT_CORPUS:
+            assert (_split_or_error(fast_split, line) ==
+                    _split_or_error(shlex_split, line)), line
+
+    def test_random(self):
+        rng = random.Random(0)
+        chars = "ab '\"\\\t\n\0#"
+        for _ in range(20000):
+            line = "".join(rng.choice(chars)
+                           for _ in range(rng.randint(0, 12)))
+            assert (_split_or_error(fast_split, line) ==
+                    _split_or_error(shlex_split, line)), line
+
+    def test_split_override(self):
+        class CommaUI(UI):
+            def split(self, line):
+                return line.split(",")
+        out = StringIO()
+        CommaUI(stdout=out).onecmd("multiply 2,1,3")
+        assert out.getvalue().strip() == "2\n6"
+
 if __name__ == "__main__":
     UI(show_usage=True).cmdloop()
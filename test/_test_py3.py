@@ -1,5 +1,16 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
 from parsedcmd import *
+from parsedcmd import (
+    ScriptResult, _read_argfile, fast_split, shlex_split)
 
 class UI(ParsedCmd):
     def do_print(self, line="abc", *, flag: boolean=True, repeat: int=1):
@@ -23,6 +34,11 @@ class UI(ParsedCmd):
         """
         eval(line)
 
+class LazyUI(UI):
+    @parallel_safe
+    def do_total(self, nums: many(int, lazy=True)):
+        print(sum(nums), file=self.stdout)
+
 class Tests:
     def setup(self):
         self.out = StringIO()
@@ -55,9 +71,726 @@ class Tests:
         assert (self.out.getvalue().strip() ==
                 UI.do_multiply.__doc__ + "\n\tmultiply MUL [NUMS]")
 
+    def test_subclass_binding(self):
+        self.ui.onecmd("multiply 2 3")
+        class SubUI(UI):
+            def do_multiply(self, mul: float, *nums: float):
+                UI.do_multiply(self, mul, *nums)
+        SubUI(stdout=self.out).onecmd("multiply 2 3")
+        assert self.out.getvalue().strip() == "6\n6.0"
+
+    def test_uncompiled_bindings(self):
+        self.ui.compile_bindings = False
+        self.ui.onecmd("print -repeat 2 def")
+        assert self.out.getvalue().strip() == "def\ndef"
+
+    def test_run_script(self):
+        result = self.ui.run_script(
+            ["multiply 2 1", "", "multiply x", "print -repeat 2 def"])
+        output = self.out.getvalue()
+        assert output.startswith("2\n*** While trying to cast \"x\"")
+        assert output.endswith("'x'def\ndef\n")
+        assert list(result.statuses) == [
+            ScriptResult.OK, ScriptResult.SKIPPED, ScriptResult.CAST_ERROR,
+            ScriptResult.OK]
+        assert result.error_lines == [3]
+
+    def test_run_script_stop_on_error(self):
+        result = self.ui.run_script(
+            StringIO("multiply 2 1\nmultiply\nmultiply 3 1\n"),
+            stop_on_error=True)
+        assert self.out.getvalue().startswith("2\n*** ")
+        assert len(result) == 2
+        assert result.errors[0][:2] == (2, ScriptResult.BIND_ERROR)
+
+    def test_run_script_parallel(self):
+        class ParallelUI(UI):
+            @parallel_safe
+            def do_sleep(self, delay: float, tag):
+                time.sleep(delay)
+                print(tag, file=self.stdout)
+        lines = ["sleep {0} {1}".format(0.01 * (i % 3), i) for i in range(10)]
+        lines[5] = "sleep x 5"
+        with ThreadPoolExecutor(4) as executor:
+            result = ParallelUI(stdout=self.out).run_script(
+                lines + ["multiply 2 1"], executor=executor, max_pending=2)
+        output = self.out.getvalue().split("\n")
+        assert output[:5] == ["0", "1", "2", "3", "4"]
+        assert output[-5:] == ["7", "8", "9", "2", ""]
+        assert output[-6].endswith("'x'6")
+        assert result.error_lines == [6]
+
+    def test_run_script_parallel_cast_error(self):
+        from concurrent.futures import ProcessPoolExecutor
+        for executor_class in [ThreadPoolExecutor, ProcessPoolExecutor]:
+            out = StringIO()
+            with executor_class(2) as executor:
+                result = LazyUI(stdout=out).run_script(
+                    ["total 1 2", "total 1 x", "total 3"], executor=executor)
+            output = out.getvalue().split("\n")
+            assert output[0] == "3"
+            assert output[1].startswith("*** While")
+            assert output[-2].endswith("'x'3") and output[-1] == ""
+            assert list(result.statuses) == [
+                ScriptResult.OK, ScriptResult.CAST_ERROR, ScriptResult.OK]
+
+    def test_validate_script(self):
+        class ValidateUI(UI):
+            def do_lazy(self, nums: many(int, lazy=True)):
+                raise AssertionError("validation must not run commands")
+        lines = ["multiply 2 1", "", "multiply x", "print -repeat 2 def",
+                 "lazy 1 x", "nope", "print a b"]
+        result = ValidateUI(stdout=self.out).validate_script(lines)
+        assert self.out.getvalue() == ""
+        assert list(result.statuses) == [
+            ScriptResult.OK, ScriptResult.SKIPPED, ScriptResult.CAST_ERROR,
+            ScriptResult.OK, ScriptResult.CAST_ERROR, ScriptResult.UNKNOWN,
+            ScriptResult.BIND_ERROR]
+        assert result.error_lines == [3, 5, 6, 7]
+        assert result.errors[2] == (6, ScriptResult.UNKNOWN, "nope")
+
+    def test_validate_script_pipeline(self):
+        ui = UI(stdout=self.out, pipe_symbol="|")
+        result = ui.validate_script(
+            ["multiply 2 1 | multiply 3", "multiply 2 | print",
+             "multiply x | multiply 3", "multiply 2 | nope",
+             "shell print(1 | 2)"])
+        assert self.out.getvalue() == ""
+        assert list(result.statuses) == [
+            ScriptResult.OK, ScriptResult.BIND_ERROR, ScriptResult.CAST_ERROR,
+            ScriptResult.UNKNOWN, ScriptResult.OK]
+
+    def test_validate_script_parallel(self):
+        from concurrent.futures import ProcessPoolExecutor
+        lines = ["multiply {0} {1}".format(i, i if i % 7 else "x")
+                 for i in range(1, 101)]
+        with ProcessPoolExecutor(2) as executor:
+            result = self.ui.validate_script(
+                lines, executor=executor, chunk_size=16, max_pending=1)
+        assert len(result) == 100
+        assert result.error_lines == list(range(7, 101, 7))
+        assert "'x'" in str(result.errors[0][2])
+        assert self.out.getvalue() == ""
+
+    def test_async_command(self):
+        class AsyncUI(UI):
+            async def do_sleep(self, delay: float, tag):
+                await asyncio.sleep(delay)
+                print(tag, file=self.stdout)
+        ui = AsyncUI(stdout=self.out)
+        ui.onecmd("sleep 0 a")
+        asyncio.run(ui.aonecmd("sleep 0 b"))
+        assert self.out.getvalue().strip() == "a\nb"
+
+    def test_acmdloop(self):
+        class AsyncUI(UI):
+            async def do_sleep(self, delay: float, tag):
+                await asyncio.sleep(delay)
+                print(tag, file=self.stdout)
+            async def do_EOF(self):
+                await asyncio.sleep(0.05)
+                return True
+        ui = AsyncUI(stdin=StringIO("sleep 0.01 slow\nprint fast\n"),
+                     stdout=self.out)
+        ui.use_rawinput = False
+        ui.prompt = ""
+        asyncio.run(ui.acmdloop())
+        assert self.out.getvalue().strip() == "fast\nslow"
+
+    def test_server(self):
+        async def client(connect, lines):
+            reader, writer = await connect
+            writer.write(lines.encode())
+            writer.write_eof()
+            output = await reader.read()
+            writer.close()
+            return output.decode()
+        async def main():
+            server = CmdServer(UI, show_usage=True)
+            tcp = await server.start_tcp("127.0.0.1", 0)
+            port = tcp.sockets[0].getsockname()[1]
+            connections = [asyncio.open_connection("127.0.0.1", port)]
+            if hasattr(socket, "AF_UNIX"):
+                path = os.path.join(tempfile.mkdtemp(), "sock")
+                await server.start_unix(path)
+                connections.append(asyncio.open_unix_connection(path))
+            outputs = await asyncio.gather(*[
+                client(connection, "multiply 2 1\nprint -repeat 2 x\n")
+                for connection in connections])
+            await server.close()
+            return outputs
+        for output in asyncio.run(main()):
+            assert output == "(Cmd) 2\n(Cmd) x\nx\n(Cmd) "
+
+    def test_server_limits(self):
+        async def main():
+            server = CmdServer(UI, max_connections=1, idle_timeout=0.05)
+            tcp = await server.start_tcp("127.0.0.1", 0)
+            port = tcp.sockets[0].getsockname()[1]
+            reader1, writer1 = await asyncio.open_connection("127.0.0.1", port)
+            await reader1.readuntil(b"(Cmd) ")
+            reader2, writer2 = await asyncio.open_connection("127.0.0.1", port)
+            refused = await reader2.read()
+            timed_out = await reader1.read()
+            writer1.close()
+            writer2.close()
+            await server.close()
+            return refused, timed_out
+        refused, timed_out = asyncio.run(main())
+        assert refused == b"*** Too many connections.\n"
+        assert timed_out == b"\n*** Idle timeout.\n"
+
+    def test_stats(self):
+        class StatsUI(UI):
+            do_stats = stats_command
+        ui = StatsUI(stdout=self.out, stats=True)
+        for line in ["multiply 2 1", "multiply x", "multiply", "print"]:
+            ui.onecmd(line)
+        stat = ui.stats.commands["multiply"]
+        assert (stat.calls, stat.bind_errors, stat.cast_errors) == (3, 1, 1)
+        assert sum(stat.histogram) == 1
+        self.out.truncate(0)
+        self.out.seek(0)
+        ui.onecmd("stats")
+        lines = self.out.getvalue().splitlines()
+        assert lines[0].split() == ["command", "calls", "bind", "cast", "exc",
+                                    "split", "bind", "cast", "run"]
+        assert lines[1].split()[:5] == ["multiply", "3", "1", "1", "0"]
+        assert lines[2].split()[:5] == ["print", "1", "0", "0", "0"]
+        ui.onecmd("stats reset")
+        assert list(ui.stats.commands) == ["stats"]
+
+    def test_complete(self):
+        assert self.ui.completenames("m") == ["multiply"]
+        assert self.ui.completedefault("-", "print -", 6, 7) == [
+            "-flag", "-repeat"]
+        assert self.ui.completedefault("-", "print -flag on -", 15, 16) == [
+            "-repeat"]
+        assert self.ui.completedefault("o", "print -flag o", 12, 13) == [
+            "off", "on"]
+        assert self.ui.completedefault("", "shell ", 6, 6) == []
+
+    def test_help_cached(self):
+        self.ui.onecmd("help")
+        self.ui.onecmd("help")
+        output = self.out.getvalue()
+        assert output[:len(output) // 2] == output[len(output) // 2:]
+        assert "multiply  print  shell" in output
+        UI.do_zzz = UI.do_multiply
+        try:
+            self.ui.onecmd("help")
+        finally:
+            del UI.do_zzz
+        assert "multiply  print  shell  zzz" in self.out.getvalue()
+
+    def test_command_index_invalidation(self):
+        class SubUI(UI):
+            def do_foo(self):
+                pass
+        ui = SubUI(stdout=self.out)
+        assert ui.completenames("f") == ["foo"]
+        del SubUI.do_foo
+        SubUI.do_bar = lambda self: None
+        assert ui.completenames("f") == []
+        assert ui.completenames("b") == ["bar"]
+        UI.do_baz = lambda self: None
+        try:
+            assert ui.completenames("b") == ["bar", "baz"]
+        finally:
+            del UI.do_baz
+        assert ui.completenames("b") == ["bar"]
+
+    def test_help_cache_invalidation(self):
+        class SubUI(UI):
+            def do_foo(self):
+                pass
+        ui = SubUI(stdout=self.out)
+        ui.onecmd("help")
+        del SubUI.do_foo
+        SubUI.do_bar = lambda self: None
+        ui.onecmd("help")
+        assert self.out.getvalue().endswith(
+            "Undocumented commands:\n======================\nbar  help\n\n")
+        SubUI.do_bar = UI.do_multiply
+        ui.onecmd("help")
+        assert self.out.getvalue().endswith(
+            "bar  multiply  print  shell\n\n"
+            "Undocumented commands:\n======================\nhelp\n\n")
+
+
+    def test_command_signatures(self):
+        signatures = UI.command_signatures()
+        assert signatures["multiply"]["usage"] == "\tmultiply MUL [NUMS]"
+        assert signatures["multiply"]["parameters"] == [
+            {"name": "mul", "kind": "positional", "caster": "int"},
+            {"name": "nums", "kind": "varargs", "caster": "int"}]
+        assert signatures["shell"]["gets_raw"]
+        assert signatures["shell"]["parameters"] is None
+
+    def test_lazy_command(self):
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, "_lazy_plugin.py"), "w") as file:
+            file.write('def greet(self, name, times=1):\n'
+                       '    """Greet someone."""\n'
+                       '    self.stdout.write("hello " + name + "\\n")\n')
+        sys.path.insert(0, directory)
+        try:
+            class LazyUI(UI):
+                pass
+            LazyUI.register_lazy(
+                "greet", "_lazy_plugin:greet",
+                {"doc": "Greet someone.", "gets_raw": False,
+                 "usage": "\tgreet [TIMES(=1)] NAME",
+                 "parameters": [
+                     {"name": "name", "kind": "positional"},
+                     {"name": "times", "kind": "optional", "default": 1}]})
+            out = StringIO()
+            ui = LazyUI(stdout=out)
+            ui.onecmd("help")
+            ui.onecmd("help greet")
+            assert "greet" in out.getvalue()
+            assert "Greet someone." in out.getvalue()
+            signatures = LazyUI.command_signatures()
+            assert signatures["greet"]["doc"] == "Greet someone."
+            assert "_lazy_plugin" not in sys.modules
+            ui.onecmd("greet world")
+            assert "_lazy_plugin" in sys.modules
+            assert out.getvalue().endswith("hello world\n")
+            assert not isinstance(vars(LazyUI)["do_greet"], LazyCommand)
+        finally:
+            sys.path.remove(directory)
+            sys.modules.pop("_lazy_plugin", None)
+            shutil.rmtree(directory)
+
+    def test_main(self):
+        assert self.ui.main(["print", "-repeat", "2", "a 'b' \\c"]) == 0
+        assert self.out.getvalue() == "a 'b' \\c\na 'b' \\c\n"
+        assert self.ui.main(["multiply", "2", "x"]) == 2
+        assert self.ui.main(["print", "a", "b"]) == 2
+        assert self.ui.main(["nonexistent"]) == 2
+        assert self.out.getvalue().endswith(
+            "*** Unknown syntax: nonexistent\n")
+
+    def test_cast_error_index(self):
+        self.ui.onecmd("multiply 2 1 x")
+        assert '"nums[1]"' in self.out.getvalue()
+
+    def test_many(self):
+        class ManyUI(UI):
+            def do_sum(self, mul: int, nums: many(int)):
+                print(mul * sum(nums), file=self.stdout)
+
+            def do_lazy(self, nums: many(int, lazy=True)):
+                for num in nums:
+                    print(num, file=self.stdout)
+        ui = ManyUI(stdout=self.out)
+        ui.onecmd("sum 2 1 2 3")
+        ui.onecmd("sum 2")
+        assert self.out.getvalue() == "12\n0\n"
+        ui.onecmd("lazy 1 x 3")
+        assert self.out.getvalue().startswith("12\n0\n1\n*** While")
+        assert '"nums[1]"' in self.out.getvalue()
+
+    def test_many_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            return
+        class ArrayUI(UI):
+            def do_sum(self, nums: many(dtype=float)):
+                print(type(nums).__name__, nums.sum(), file=self.stdout)
+        ui = ArrayUI(stdout=self.out)
+        ui.onecmd("sum 1 2.5")
+        assert self.out.getvalue() == "ndarray 3.5\n"
+        ui.onecmd("sum 1 x")
+        assert '"nums[1]"' in self.out.getvalue()
+
+    def test_argfile(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "nums.txt")
+        with open(path, "w") as file:
+            file.write("1 2\n  3\n")
+        try:
+            self.ui.argfile_prefix = "@"
+            self.ui.onecmd("multiply -2 @" + path)
+            self.ui.onecmd("print -repeat 1 @" + path)
+            assert self.out.getvalue().startswith(
+                "-2\n-4\n-6\n*** This argument list could not be bound")
+            self.ui.onecmd("multiply 2 @" + path + ".missing")
+            assert "No such file" in self.out.getvalue()
+            self.ui.onecmd("!print('@x', file=self.stdout)")
+            assert self.out.getvalue().endswith("@x\n")
+            with open(path, "rb") as file:
+                assert list(_read_argfile(file, 3)) == ["1", "2", "3"]
+            class LazyUI(UI):
+                def do_sum(self, mul: int, nums: many(int, lazy=True)):
+                    print(mul * sum(nums), file=self.stdout)
+            LazyUI(stdout=self.out, argfile_prefix="@").onecmd(
+                "sum 2 @" + path + " 4")
+            assert self.out.getvalue().endswith("@x\n20\n")
+            bad = os.path.join(directory, "bad.txt")
+            with open(bad, "wb") as file:
+                file.write(b"1 \xff 3\n")
+            self.ui.onecmd("multiply 2 @" + bad)
+            assert self.out.getvalue().endswith("invalid start byte\n")
+            assert "*** This argument list could not be bound" in (
+                self.out.getvalue().rsplit("20\n", 1)[1])
+            LazyUI(stdout=self.out, argfile_prefix="@").onecmd(
+                "sum 2 @" + bad)
+            assert "*** While trying to cast \"@" + bad in (
+                self.out.getvalue())
+            assert self.out.getvalue().endswith("invalid start byte")
+        finally:
+            shutil.rmtree(directory)
+
+    def test_pipeline(self):
+        class PipeUI(UI):
+            def do_range(self, n: int):
+                for i in range(n):
+                    yield i
+
+            def do_square(self, *nums):
+                return [num ** 2 for num in nums]
+
+            def do_total(self, nums: many(lazy=True)):
+                print(sum(nums), file=self.stdout)
+        ui = PipeUI(stdout=self.out, pipe_symbol="|")
+        ui.onecmd("range 3 | multiply 2")
+        ui.onecmd("range 3 | square | total")
+        ui.onecmd("range 3 | square")
+        ui.onecmd("print a|b")
+        ui.onecmd("print '|'")
+        assert self.out.getvalue() == "0\n2\n4\n5\n0\n1\n4\na|b\n|\n"
+        ui.onecmd("range 3 | print")
+        assert self.out.getvalue().endswith(
+            "*** This command does not take piped input.\n")
+
+    def test_pipeline_raw_and_bare(self):
+        class PipeUI(UI):
+            def do_range(self, n):
+                return iter(range(int(n)))
+        ui = PipeUI(stdout=self.out, pipe_symbol="|")
+        ui.onecmd("shell print(1 | 2, file=self.stdout)")
+        assert ui.onecmd("range 2") is None
+        assert self.out.getvalue() == "3\n0\n1\n"
+        result = ui.run_script(["range 3 | multiply 2", "range 2 | print"])
+        assert list(result.statuses) == [
+            ScriptResult.OK, ScriptResult.BIND_ERROR]
+        assert self.out.getvalue().startswith("3\n0\n1\n0\n2\n4\n*** ")
+        # Without pipelines, results are returned as by Cmd.onecmd.
+        out = StringIO()
+        ui = PipeUI(stdout=out)
+        assert ui.onecmd("range 2") is not None
+        assert ui.run_script(["range 2"]).statuses[0] == ScriptResult.STOP
+        assert ui.main(["range", "2"]) == 0
+        assert out.getvalue() == ""
+
+    def test_cached(self):
+        class CachedUI(UI):
+            calls = 0
+
+            @cached(maxsize=2)
+            def do_lookup(self, key: int):
+                CachedUI.calls += 1
+                print(key * 2, file=self.stdout)
+
+            @cached(ttl=0)
+            def do_expiring(self):
+                CachedUI.calls += 1
+
+            @invalidates("lookup")
+            def do_update(self):
+                pass
+        ui = CachedUI(stdout=self.out)
+        for line in ["lookup 1", "lookup 01", "lookup 2", "lookup 3",
+                     "lookup 1", "update", "lookup 3"]:
+            ui.onecmd(line)
+        assert self.out.getvalue() == "2\n2\n4\n6\n2\n6\n"
+        assert CachedUI.calls == 5
+        ui.onecmd("expiring")
+        ui.onecmd("expiring")
+        assert CachedUI.calls == 7
+        info = CachedUI.command_cache_info()
+        assert info["lookup"] == (1, 5, 2, 1, 2)
+        assert info["expiring"] == (0, 2, 1, 1, 128)
+        other = CachedUI(stdout=StringIO())
+        other.onecmd("lookup 3")
+        assert CachedUI.calls == 8
+        assert other.stdout.getvalue() == "6\n"
+
+    def test_cached_parallel(self):
+        class CachedUI(UI):
+            @parallel_safe
+            @cached()
+            def do_double(self, key: int):
+                time.sleep(0.001 * (key % 3))
+                print(key * 2, file=self.stdout)
+        ui = CachedUI(stdout=self.out)
+        lines = ["double {0}".format(i % 5) for i in range(20)]
+        with ThreadPoolExecutor(4) as executor:
+            result = ui.run_script(lines, executor=executor)
+        assert not result.error_lines
+        ui.onecmd("double 0")
+        assert self.out.getvalue().split() == [
+            str(i % 5 * 2) for i in range(21)]
+
+    def test_casters(self):
+        import datetime
+        import enum
+        class Color(enum.Enum):
+            red = 1
+            green = 2
+        calls = []
+        @caster(pure=True, completions=["1", "2"], metavar="N")
+        def counted(value):
+            calls.append(value)
+            return int(value)
+        class CasterUI(UI):
+            def do_paint(self, color: Color=Color.red, *, times: counted=1,
+                         day: datetime.date=None):
+                print(color.name, times, day, file=self.stdout)
+        ui = CasterUI(stdout=self.out, show_usage=True)
+        ui.onecmd("paint")
+        ui.onecmd("paint -times 2 green")
+        ui.onecmd("paint -times 2 -day 2020-01-02 green")
+        assert self.out.getvalue() == (
+            "red 1 None\ngreen 2 None\ngreen 2 2020-01-02\n")
+        assert calls == ["2"]
+        assert ui.completedefault("g", "paint g", 6, 7) == ["green"]
+        assert ui.completedefault("", "paint -times ", 13, 13) == ["1", "2"]
+        ui.onecmd("help paint")
+        assert "[-times N(=1)]" in self.out.getvalue()
+        signature = CasterUI.command_signatures()["paint"]
+        assert signature["parameters"][0]["completions"] == ["green", "red"]
+
+    def test_record_replay(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "session.log")
+        try:
+            with CommandRecorder(path) as recorder:
+                ui = UI(stdout=self.out, recorder=recorder)
+                for line in ["print -repeat 2 'a b'", "multiply 2 x",
+                             "nonexistent", "!print(1, file=self.stdout)"]:
+                    ui.onecmd(line)
+            entries = list(CommandRecorder.read(path))
+            assert entries[0].strings == [
+                "print -repeat 2 'a b'", "print", "-repeat", "2", "a b"]
+            assert [entry.status for entry in entries] == [
+                ScriptResult.OK, ScriptResult.CAST_ERROR,
+                ScriptResult.UNKNOWN, ScriptResult.OK]
+            out = StringIO()
+            result = UI(stdout=out).replay(path)
+            assert result.ok and len(result) == 4 and not out.getvalue()
+            class ChangedUI(UI):
+                @staticmethod
+                def tokenizer(line):
+                    raise AssertionError("replayed arguments are not split")
+
+                def do_print(self, line="abc", *, flag: boolean=True,
+                             repeat: int=1):
+                    print(line.upper(), file=self.stdout)
+            result = ChangedUI().replay(path)
+            assert [divergence[:2] for divergence in result.divergences] == [
+                (0, "print -repeat 2 'a b'")]
+        finally:
+            shutil.rmtree(directory)
+
+    def test_record_with_stats(self):
+        class SplitUI(UI):
+            def construct_arglist(self, arg, func, inner_func):
+                self.constructed += 1
+                return UI.construct_arglist(self, arg, func, inner_func)
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "session.log")
+        try:
+            with CommandRecorder(path) as recorder:
+                ui = SplitUI(stdout=self.out, recorder=recorder, stats=True)
+                ui.constructed = 0
+                ui.onecmd("multiply 2 1")
+                ui.compile_bindings = False
+                ui.onecmd("print -repeat 2 a")
+            assert ui.stats.commands["multiply"].calls == 1
+            assert ui.stats.commands["print"].calls == 1
+            assert ui.constructed == 2
+            assert self.out.getvalue() == "2\na\na\n"
+            ui = SplitUI(stdout=self.out, stats=True)
+            ui.constructed = 0
+            assert ui.replay(path).ok
+            assert ui.stats.commands["multiply"].calls == 1
+            assert ui.constructed == 2
+        finally:
+            shutil.rmtree(directory)
+
+    def test_buffered_output(self):
+        class Stream(object):
+            def __init__(self):
+                self.writes = []
+                self.flushes = 0
+
+            def write(self, data):
+                self.writes.append(data)
+
+            def flush(self):
+                self.flushes += 1
+        stream = Stream()
+        ui = UI(stdout=stream, buffer_output="command")
+        ui.onecmd("print -repeat 3 def")
+        assert stream.writes == ["def\ndef\ndef\n"] and stream.flushes == 1
+        ui.stdout.write("x")
+        assert stream.writes[-1] == "x"
+        stream = Stream()
+        ui = UI(stdout=BufferedOutput(stream, "size", size=10))
+        ui.onecmd("print -repeat 2 abc")
+        assert stream.writes == []
+        ui.onecmd("print -repeat 2 abc")
+        assert stream.writes == ["abc\nabc\nabc"]
+        ui.stdout.flush()
+        assert stream.writes == ["abc\nabc\nabc", "\nabc\n"]
+        stream = Stream()
+        ui = UI(stdout=stream, buffer_output="immediate")
+        ui.onecmd("print -repeat 2 abc")
+        assert stream.writes == ["abc", "\n", "abc", "\n"]
+
+    def test_buffered_output_cmdloop(self):
+        class LoopUI(UI):
+            def do_quit(self):
+                return True
+        ui = LoopUI(stdin=StringIO("print -repeat 2 a\nquit\n"),
+                    stdout=BufferedOutput(self.out, "size"))
+        ui.use_rawinput = False
+        ui.cmdloop("intro")
+        assert self.out.getvalue() == "intro\n(Cmd) a\na\n(Cmd) "
+
+    def test_timeout(self):
+        class SlowUI(UI):
+            @timeout(0.05)
+            def do_spin(self):
+                while True:
+                    self.cancel_token.check()
+                    time.sleep(0.001)
+
+            def do_wait(self, delay: float):
+                time.sleep(delay)
+                self.cancel_token.check()
+                print("done", file=self.stdout)
+
+            @timeout(None)
+            def do_free(self):
+                self.cancel_token.check()
+                print("free", file=self.stdout)
+
+            def do_stop(self):
+                self.cancel_token.cancel()
+                self.cancel_token.check()
+
+            def do_nap(self, delay: float):
+                time.sleep(delay)
+                print("woke", file=self.stdout)
+        ui = SlowUI(stdout=self.out, command_timeout=0.02)
+        ui.onecmd("spin")
+        assert self.out.getvalue() == (
+            '*** Command "spin" timed out after 0.05 s.\n')
+        ui.onecmd("wait 0")
+        ui.onecmd("free")
+        ui.onecmd("stop")
+        assert self.out.getvalue().endswith(
+            'done\nfree\n*** Command "stop" was cancelled.\n')
+        ui.onecmd("nap 0.03")
+        assert self.out.getvalue().endswith(
+            'woke\n*** Command "nap" timed out after 0.02 s.\n')
+        result = ui.run_script(["wait 0.03", "wait 0"])
+        assert result.errors[0][:2] == (1, ScriptResult.CANCELLED)
+        assert ui.main(["wait", "0.03"]) == 1
+        assert not ui.cancel_token.cancelled
+
+    def test_timeout_parallel(self):
+        class SlowUI(UI):
+            @parallel_safe
+            @timeout(0.02)
+            def do_spin(self):
+                while True:
+                    self.cancel_token.check()
+                    time.sleep(0.001)
+
+            @parallel_safe
+            def do_wait(self, delay: float):
+                for i in range(int(delay * 1000)):
+                    self.cancel_token.check()
+                    time.sleep(0.001)
+                print("done", file=self.stdout)
+        ui = SlowUI(stdout=self.out)
+        with ThreadPoolExecutor(2) as executor:
+            result = ui.run_script(["spin", "wait 0.05"], executor=executor)
+        assert list(result.statuses) == [
+            ScriptResult.CANCELLED, ScriptResult.OK]
+        assert self.out.getvalue() == (
+            '*** Command "spin" timed out after 0.02 s.\ndone\n')
+        assert not ui.cancel_token.cancelled
+
+    def test_timeout_async(self):
+        class AsyncUI(UI):
+            @timeout(0.02)
+            async def do_sleep(self, delay: float):
+                await asyncio.sleep(delay)
+                print("slept", file=self.stdout)
+
+            @timeout(5)
+            async def do_token(self):
+                await asyncio.sleep(0)
+                print(self.cancel_token.timeout, file=self.stdout)
+        async def run_in_loop(line):
+            await ui.onecmd(line)
+        ui = AsyncUI(stdout=self.out)
+        asyncio.run(run_in_loop("token"))
+        assert self.out.getvalue() == "5\n"
+        assert ui.cancel_token.timeout is None
+        self.out.truncate(0)
+        self.out.seek(0)
+        ui.onecmd("sleep 0")
+        ui.onecmd("sleep 10")
+        asyncio.run(ui.aonecmd("sleep 10"))
+        assert self.out.getvalue() == "slept\n" + (
+            '*** Command "sleep" timed out after 0.02 s.\n' * 2)
+
     def test_shell(self):
         self.ui.onecmd("!print(1, file=self.stdout)")
         assert self.out.getvalue().strip() == "1"
 
+SPLIT_CORPUS = [
+    "", "  ", "print", "print -repeat 3 def", " a\tb\r\nc ", "a\0b",
+    "'a b' \"c d\"", "a'b'c\"d\"e", "''", "a '' b", '""', "'\\'",
+    '"\\""', '"\\\\"', '"\\a"', "a\\ b", "a\\", "'a", '"a', '"a\\',
+    '"a\\"', "a\\\nb", "#a b#", "\u00e9 \u00e0", "a\x0bb", "\\\0",
+]
+
+def _split_or_error(split, line):
+    try:
+        return split(line)
+    except ValueError as exc:
+        return str(exc)
+
+class TestSplit:
+    def test_corpus(self):
+        for line in SPLIT_CORPUS:
+            assert (_split_or_error(fast_split, line) ==
+                    _split_or_error(shlex_split, line)), line
+
+    def test_random(self):
+        rng = random.Random(0)
+        chars = "ab '\"\\\t\n\0#"
+        for _ in range(20000):
+            line = "".join(rng.choice(chars)
+                           for _ in range(rng.randint(0, 12)))
+            assert (_split_or_error(fast_split, line) ==
+                    _split_or_error(shlex_split, line)), line
+
+    def test_split_override(self):
+        class CommaUI(UI):
+            def split(self, line):
+                return line.split(",")
+        out = StringIO()
+        CommaUI(stdout=out).onecmd("multiply 2,1,3")
+        assert out.getvalue().strip() == "2\n6"
+
 if __name__ == "__main__":
     UI(show_usage=True).cmdloop()
@@ -0,0 +1,225 @@
+"""Benchmark of the dispatch overhead of ParsedCmd.
+
+Each case dispatches a fixed line through `onecmd', both with a plain cmd.Cmd
+(whose `do_*' method gets the raw line) and with ParsedCmd, and reports the
+throughput in lines per second and the peak memory allocated while dispatching
+a line (as traced by tracemalloc).  The `do_*' methods do nothing, so that only
+the dispatch overhead is measured.
+
+    python test/bench_dispatch.py                  # benchmark the working tree
+    python test/bench_dispatch.py --rev HEAD~1     # benchmark a git revision
+    python test/bench_dispatch.py --json new.json  # save the results
+    python test/bench_dispatch.py --compare old.json  # compare with old results
+"""
+
+from __future__ import print_function
+import argparse
+from cmd import Cmd
+import functools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class NullOutput(object):
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+def wrap(func, depth):
+    """Wrap func in depth functools.wraps wrappers."""
+    for _ in range(depth):
+        func = functools.wraps(func)(
+            lambda *args, _func=func, **kwargs: _func(*args, **kwargs))
+    return func
+
+def make_classes(parsedcmd):
+    """Return the plain Cmd and the ParsedCmd classes used by the cases."""
+
+    class PlainUI(Cmd):
+        def default(self, line):
+            pass
+
+    class UI(parsedcmd.ParsedCmd):
+        def do_noop(self):
+            pass
+
+        def do_print(self, line="abc", *,
+                     flag: parsedcmd.boolean=True, repeat: int=1):
+            pass
+
+        def do_multiply(self, mul: int, *nums: int):
+            pass
+
+        def do_echo(self, *words):
+            pass
+
+        @parsedcmd.gets_raw
+        def do_shell(self, line):
+            pass
+
+        def _wrapped(self, a: int, b: float=2., *, c: int=3):
+            pass
+
+        do_wrapped1 = wrap(_wrapped, 1)
+        do_wrapped10 = wrap(_wrapped, 10)
+
+        def do_flags(self, *flags: parsedcmd.boolean):
+            pass
+
+        if hasattr(parsedcmd, "many"):
+            def do_many(self, mul: int, nums: parsedcmd.many(int)):
+                pass
+
+            def do_lazy(self, mul: int,
+                        nums: parsedcmd.many(int, lazy=True)):
+                for num in nums:
+                    pass
+
+    for name in dir(UI):
+        if name.startswith("do_"):
+            setattr(PlainUI, name, lambda self, arg: None)
+    return PlainUI, UI
+
+def numbers(n):
+    return " ".join(str(i) for i in range(n))
+
+CASES = [
+    ("no arguments", "noop"),
+    ("kw-only options", "print -flag off -repeat 3 def"),
+    ("*args x10", "multiply 3 " + numbers(10)),
+    ("*args x100", "multiply 3 " + numbers(100)),
+    ("*args x1000", "multiply 3 " + numbers(1000)),
+    ("*args x10000", "multiply 3 " + numbers(10000)),
+    ("boolean x10000", "flags " + " ".join(["on", "off"] * 5000)),
+    ("many x10000", "many 3 " + numbers(10000)),
+    ("lazy x10000", "lazy 3 " + numbers(10000)),
+    ("quoted", "echo 'a b' \"c \\\"d\\\"\" e\\ f g"),
+    ("@gets_raw", "shell print('some raw text')"),
+    ("__wrapped__ x1", "wrapped1 -c 4 1 2.5"),
+    ("__wrapped__ x10", "wrapped10 1 2.5"),
+    ("failing bind", "noop extra arguments"),
+    ("failing cast", "multiply 3 1 2 x"),
+]
+
+def time_line(ui, line, min_time):
+    """Return the best time per dispatch of line, in seconds."""
+    timer = timeit.Timer(lambda: ui.onecmd(line))
+    number = 1
+    while True:
+        if timer.timeit(number) >= min_time / 5:
+            break
+        number *= 2
+    return min(timer.repeat(5, number)) / number
+
+def peak_memory(ui, line, repeat=10):
+    """Return the mean peak memory allocated while dispatching line."""
+    ui.onecmd(line)
+    tracemalloc.start()
+    try:
+        total = 0
+        for _ in range(repeat):
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            ui.onecmd(line)
+            total += tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    return total / repeat
+
+def run(parsedcmd, min_time):
+    PlainUI, UI = make_classes(parsedcmd)
+    plain = PlainUI(stdout=NullOutput())
+    parsed = UI(stdout=NullOutput())
+    results = {}
+    for name, line in CASES:
+        if not hasattr(UI, "do_" + line.split()[0]):
+            continue  # not supported by this revision
+        plain_time = time_line(plain, line, min_time)
+        parsed_time = time_line(parsed, line, min_time)
+        results[name] = {
+            "plain_lines_per_s": 1 / plain_time,
+            "parsed_lines_per_s": 1 / parsed_time,
+            "plain_peak_bytes": peak_memory(plain, line),
+            "parsed_peak_bytes": peak_memory(parsed, line),
+        }
+    return results
+
+def load_revision(rev):
+    """Import parsedcmd as of a git revision."""
+    directory = tempfile.mkdtemp()
+    for module in ["parsedcmd.py", "_parsedcmd_async.py"]:
+        try:
+            source = subprocess.check_output(
+                ["git", "show", "{0}:{1}".format(rev, module)], cwd=ROOT,
+                stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            continue
+        with open(os.path.join(directory, module), "wb") as file:
+            file.write(source)
+    sys.path.insert(0, directory)
+    try:
+        import parsedcmd
+    finally:
+        sys.path.remove(directory)
+        shutil.rmtree(directory)
+    return parsedcmd
+
+def print_results(results, old=None):
+    header = "{0:<18}{1:>14}{2:>14}{3:>12}{4:>12}".format(
+        "case", "Cmd lines/s", "lines/s", "Cmd B/line", "B/line")
+    if old:
+        header += "{0:>12}".format("vs. old")
+    print(header)
+    for name, line in CASES:
+        if name not in results:
+            continue
+        result = results[name]
+        row = "{0:<18}{1:>14.0f}{2:>14.0f}{3:>12.0f}{4:>12.0f}".format(
+            name, result["plain_lines_per_s"], result["parsed_lines_per_s"],
+            result["plain_peak_bytes"], result["parsed_peak_bytes"])
+        if old and name in old:
+            row += "{0:>11.2f}x".format(
+                result["parsed_lines_per_s"] /
+                old[name]["parsed_lines_per_s"])
+        print(row)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rev", help="git revision to benchmark")
+    parser.add_argument("--json", help="file to save the results to")
+    parser.add_argument("--compare", help="results to compare with")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="minimum time per measurement, in seconds")
+    args = parser.parse_args()
+    if args.rev:
+        parsedcmd = load_revision(args.rev)
+    else:
+        sys.path.insert(0, ROOT)
+        import parsedcmd
+    print("Python {0} on {1}; parsedcmd from {2}".format(
+        platform.python_version(), platform.platform(),
+        args.rev or "working tree"))
+    results = run(parsedcmd, args.min_time)
+    old = None
+    if args.compare:
+        with open(args.compare) as file:
+            old = json.load(file)["results"]
+    print_results(results, old)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"python": platform.python_version(),
+                       "revision": args.rev, "results": results},
+                      file, indent=2)
+
+if __name__ == "__main__":
+    main()
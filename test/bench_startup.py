@@ -0,0 +1,195 @@
+"""Benchmark of the startup time of ParsedCmd-based tools.
+
+One-shot invocations, as `python tool.py print -repeat 3 def' from a shell
+script, are timed (wall time of the whole process, best of several runs) when
+the tool dispatches `sys.argv' through `ParsedCmd.main', and when it joins it
+into a line for `onecmd'; starting the interpreter and importing parsedcmd are
+timed as references.
+
+A temporary package of plugin modules, each defining one command, is
+generated, together with two shells exposing all these commands: one importing
+the plugins eagerly, and one registering them with `ParsedCmd.register_lazy'
+(and their signatures, so that `help' does not import them either).  Each shell
+is started in a fresh interpreter, and the time until it is ready (the class
+is instantiated), until `help' is written and until a first command has run is
+reported (best of several runs, after a warm-up run that compiles the modules).
+
+    python test/bench_startup.py
+    python test/bench_startup.py --commands 1000 --repeat 10
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the modules must be compiled only once, by the warm-up run
+ENV = {key: value for key, value in os.environ.items()
+       if key != "PYTHONDONTWRITEBYTECODE"}
+
+PLUGIN = '''\
+import collections
+
+Point = collections.namedtuple("Point", "x y")
+
+def cmd_{i}(self, name, times: int=1, *, loud: bool=False):
+    """Command number {i}."""
+    print(name * times, file=self.stdout)
+''' + "".join('''
+def _helper_{j}(x):
+    return [Point(x, y) for y in range({j})]
+'''.format(j=j) for j in range(50))
+
+EAGER = '''\
+import parsedcmd
+{imports}
+
+class UI(parsedcmd.ParsedCmd):
+    pass
+
+for i in range({n}):
+    setattr(UI, "do_cmd_%d" % i, getattr(globals()["plugin_%d" % i],
+                                         "cmd_%d" % i))
+'''
+
+LAZY = '''\
+import json
+import parsedcmd
+
+class UI(parsedcmd.ParsedCmd):
+    pass
+
+with open({signatures!r}) as file:
+    for name, signature in json.load(file).items():
+        module = "plugins.plugin_" + name[len("cmd_"):]
+        UI.register_lazy(name, module + ":" + name, signature)
+'''
+
+TOOL = """\
+import sys
+from parsedcmd import ParsedCmd, boolean
+
+class UI(ParsedCmd):
+    def do_print(self, line="abc", *, flag: boolean=True, repeat: int=1):
+        for i in range(repeat):
+            print(line, file=self.stdout)
+
+if __name__ == "__main__":
+    %s
+"""
+
+ONE_SHOT = [
+    ("python", "", []),
+    ("import parsedcmd", "import parsedcmd\n", []),
+    ("main(argv)", TOOL % "sys.exit(UI().main())",
+     ["print", "-repeat", "3", "def"]),
+    ("onecmd(line)", TOOL % (
+        "import shlex; "
+        "UI().onecmd(' '.join(shlex.quote(arg) for arg in sys.argv[1:]))"),
+     ["print", "-repeat", "3", "def"]),
+]
+
+DRIVER = '''\
+import io, sys, time
+start = time.perf_counter()
+sys.path[:0] = [{root!r}, {directory!r}]
+from {shell} import UI
+ui = UI(stdout=io.StringIO())
+ready = time.perf_counter()
+ui.onecmd("help")
+helped = time.perf_counter()
+ui.onecmd("cmd_0 x")
+ran = time.perf_counter()
+print(ready - start, helped - start, ran - start)
+'''
+
+def generate(directory, n):
+    """Write the plugins and shells to directory."""
+    package = os.path.join(directory, "plugins")
+    os.mkdir(package)
+    open(os.path.join(package, "__init__.py"), "w").close()
+    for i in range(n):
+        with open(os.path.join(package, "plugin_{0}.py".format(i)),
+                  "w") as file:
+            file.write(PLUGIN.format(i=i))
+    with open(os.path.join(directory, "eager_shell.py"), "w") as file:
+        file.write(EAGER.format(
+            n=n, imports="\n".join(
+                "from plugins import plugin_{0}".format(i)
+                for i in range(n))))
+    # the signatures are generated once, from the eager shell
+    signatures = os.path.join(directory, "signatures.json")
+    subprocess.check_call([sys.executable, "-c", (
+        "import sys; sys.path[:0] = [{0!r}, {1!r}]\n"
+        "from eager_shell import UI\n"
+        "with open({2!r}, 'w') as file: UI.export_signatures(file)").format(
+            ROOT, directory, signatures)])
+    with open(signatures) as file:
+        commands = {name: signature
+                    for name, signature in json.load(file).items()
+                    if name.startswith("cmd_")}
+    with open(signatures, "w") as file:
+        json.dump(commands, file)
+    with open(os.path.join(directory, "lazy_shell.py"), "w") as file:
+        file.write(LAZY.format(signatures=signatures))
+
+def time_shell(directory, shell, repeat):
+    """Return the best (ready, help, first command) times of shell."""
+    driver = DRIVER.format(root=ROOT, directory=directory, shell=shell)
+    times = []
+    for _ in range(repeat + 1):  # the first run compiles the modules
+        output = subprocess.check_output([sys.executable, "-c", driver],
+                                         env=ENV)
+        times.append([float(t) for t in output.split()])
+    return [min(column) for column in zip(*times[1:])]
+
+def time_one_shot(directory, repeat):
+    """Return the best wall time of each one-shot invocation."""
+    env = dict(ENV, PYTHONPATH=ROOT)
+    results = []
+    for i, (name, source, argv) in enumerate(ONE_SHOT):
+        script = os.path.join(directory, "tool_{0}.py".format(i))
+        with open(script, "w") as file:
+            file.write(source)
+        times = []
+        for _ in range(repeat + 1):
+            start = time.perf_counter()
+            subprocess.check_call([sys.executable, script] + argv, env=env,
+                                  stdout=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+        results.append((name, min(times[1:])))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--commands", type=int, default=300,
+                        help="number of plugin commands")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of timed runs per shell")
+    args = parser.parse_args()
+    print("Python {0} on {1}; {2} commands".format(
+        platform.python_version(), platform.platform(), args.commands))
+    directory = tempfile.mkdtemp()
+    try:
+        print("{0:<20}{1:>12}".format("one-shot", "wall (s)"))
+        for name, wall in time_one_shot(directory, 4 * args.repeat):
+            print("{0:<20}{1:>12.4f}".format(name, wall))
+        print()
+        generate(directory, args.commands)
+        print("{0:<8}{1:>12}{2:>12}{3:>12}".format(
+            "shell", "ready (s)", "help (s)", "1st cmd (s)"))
+        for shell in ["eager", "lazy"]:
+            print("{0:<8}{1:>12.4f}{2:>12.4f}{3:>12.4f}".format(
+                shell, *time_shell(directory, shell + "_shell", args.repeat)))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()